@@ -0,0 +1,249 @@
+import datetime
+import time
+from typing import List, Optional, Tuple
+from ib_insync import BarData, util
+
+import intraday_data
+
+
+# benchmark intraday_data.py on synthetic data without a connection to TWS
+# usage: python benchmark.py
+
+
+# synthetic hourly bars in the shape returned by ib.reqHistoricalData()
+# volume contains the negative values IB reports for forex and cfd
+def make_synthetic_bars(number_of_bars: int, start: datetime.datetime, seed: int = 0) -> List[BarData]:
+    import random
+
+    rng = random.Random(seed)
+    bars: List[BarData] = []
+    price = 1.0 + rng.random()
+    for index in range(number_of_bars):
+        open_price = price
+        close_price = open_price + rng.gauss(0, 0.002)
+        high_price = max(open_price, close_price) + abs(rng.gauss(0, 0.001))
+        low_price = min(open_price, close_price) - abs(rng.gauss(0, 0.001))
+        volume = -1.0 if rng.random() < 0.3 else float(rng.randint(0, 5000)) + rng.choice([0.0, 0.5])
+        bars.append(BarData(date=start + datetime.timedelta(hours=index), open=open_price, high=high_price,
+                            low=low_price, close=close_price, volume=volume,
+                            average=(high_price + low_price) / 2, barCount=rng.randint(1, 100)))
+        price = close_price
+    return bars
+
+
+# clean 'volume' column. Per-row version used by transform_intraday_ib() before it was vectorised
+def legacy_clean_volume_column(volume_str: str) -> str:
+    volume = float(volume_str)
+    output = volume
+    if volume < 0:
+        output = 0
+    else:
+        output = volume
+
+    return str(output)
+
+
+# transform_intraday_ib() before it was vectorised. Kept to check output is unchanged and to measure speedup
+def legacy_transform_intraday_ib(df, fullname_value: str, ticker_value: str):
+    assert (('open' in df) and ('close' in df) and ('high' in df) and ('low' in df))
+    df["full_name"] = fullname_value
+    df["ticker"] = ticker_value
+    df['date'] = df['date'].astype(str)
+    df[['Date_YMD', 'TIME']] = df['date'].str.split(' ', n=1, expand=True)
+    df = df.drop(["date", "barCount", "average"], axis='columns')
+    df = df[['full_name', 'ticker', 'Date_YMD', 'TIME', 'open', 'high', 'low', 'close', 'volume']]
+    df['Date_YMD'] = df['Date_YMD'].str.replace("-", "")
+    df['volume'] = df['volume'].apply(legacy_clean_volume_column)
+    return df
+
+
+# compare legacy and vectorised transform_intraday_ib() on multi-year history downloaded as 360 D chunks
+# of hourly bars, as download_historical_intraday_data() does
+def benchmark_transform(number_of_chunks: int = 10, bars_per_chunk: int = 360 * 24, repeat: int = 3) -> None:
+    chunks = []
+    for index in range(number_of_chunks):
+        start = datetime.datetime(2006, 7, 5, 8) + datetime.timedelta(days=360 * index)
+        chunks.append(util.df(make_synthetic_bars(number_of_bars=bars_per_chunk, start=start, seed=index)))
+
+    for df in chunks:
+        legacy_csv = legacy_transform_intraday_ib(df.copy(), "EURUSD", "EURUSD").to_csv(index=False)
+        vectorised_csv = intraday_data.transform_intraday_ib(df.copy(), "EURUSD", "EURUSD").to_csv(index=False)
+        assert legacy_csv == vectorised_csv, "vectorised transform_intraday_ib output differs from legacy output"
+
+    results = {}
+    for name, transform in [("legacy", legacy_transform_intraday_ib),
+                            ("vectorised", intraday_data.transform_intraday_ib)]:
+        best = float("inf")
+        for _ in range(repeat):
+            copies = [df.copy() for df in chunks]  # legacy transform modifies its input
+            start_time = time.perf_counter()
+            for df in copies:
+                transform(df, "EURUSD", "EURUSD")
+            best = min(best, time.perf_counter() - start_time)
+        results[name] = best
+
+    number_of_bars = number_of_chunks * bars_per_chunk
+    print("transform_intraday_ib on " + str(number_of_chunks) + " chunks, " + str(number_of_bars) + " bars")
+    for name, seconds in results.items():
+        print("  " + name.ljust(10) + " " + format(seconds, ".3f") + " s  "
+              + format(number_of_bars / seconds, ",.0f") + " bars/s")
+    print("  speedup    " + format(results["legacy"] / results["vectorised"], ".1f") + "x")
+    return None
+
+
+# compare DataFrame and streaming csv writers on one long pull of bars. tracemalloc reports the peak of
+# memory allocated by each writer on top of the bar rows it is given
+def benchmark_csv_writer(number_of_bars: int = 360 * 24 * 12, repeat: int = 3) -> None:
+    import os
+    import tempfile
+    import tracemalloc
+
+    bars = make_synthetic_bars(number_of_bars=number_of_bars, start=datetime.datetime(2006, 7, 5, 8))
+    rows = intraday_data.get_bar_rows(bars)
+    symbol_dict = {"Symbol": "EURUSD", "FullName": "EURUSD"}
+
+    def write_with_dataframe(csv_filepath: str) -> None:
+        df = intraday_data.get_bar_frame(rows)
+        intraday_data.transform_intraday_ib(df=df, fullname_value=symbol_dict["FullName"],
+                                            ticker_value=symbol_dict["Symbol"]).to_csv(csv_filepath, index=False)
+
+    def write_streaming(csv_filepath: str) -> None:
+        intraday_data.write_bars_to_csv(rows=rows, symbol_dict=symbol_dict, csv_filepath=csv_filepath)
+
+    with tempfile.TemporaryDirectory() as folderpath:
+        results = {}
+        outputs = {}
+        for name, write in [("dataframe", write_with_dataframe), ("streaming", write_streaming)]:
+            csv_filepath = os.path.join(folderpath, name + ".csv")
+            best = float("inf")
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                write(csv_filepath)
+                best = min(best, time.perf_counter() - start_time)
+            tracemalloc.start()
+            write(csv_filepath)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = (best, peak_bytes)
+            with open(csv_filepath, "rb") as f:
+                outputs[name] = f.read()
+        assert outputs["dataframe"] == outputs["streaming"], "streaming csv output differs from DataFrame output"
+
+    print("csv writer on " + str(number_of_bars) + " bars")
+    for name, (seconds, peak_bytes) in results.items():
+        print("  " + name.ljust(10) + " " + format(seconds, ".3f") + " s  "
+              + format(number_of_bars / seconds, ",.0f") + " bars/s  peak "
+              + format(peak_bytes / 1024 ** 2, ".1f") + " MiB")
+    return None
+
+
+# forex pairs for download benchmarks, e.g. EURGBP
+def get_benchmark_pairs(number_of_symbols: int) -> List[str]:
+    import itertools
+
+    currencies = ["EUR", "GBP", "AUD", "NZD", "USD", "CAD", "CHF", "JPY", "SGD", "HKD", "NOK", "SEK"]
+    pairs = [base + quote for base, quote in itertools.permutations(currencies, 2)]
+    assert number_of_symbols <= len(pairs)
+    return pairs[:number_of_symbols]
+
+
+# run one download scenario against fake_ib_gateway.FakeIB in this process and put its results in result_queue.
+# scenario : "recent" for download_recent_intraday_data(), "historical" for chunked backfill with
+#            download_historical_intraday_data(), "incremental" for update_mode "append" after a recent download
+# Pacing limits are lifted so that the benchmark measures the client rather than IB's request budget
+def run_download_scenario(scenario: str, number_of_symbols: int, latency: float, max_concurrent_requests: int,
+                          result_queue) -> None:
+    import logging
+    import tempfile
+
+    import fake_ib_gateway
+
+    intraday_data.logger = logging.getLogger("benchmark")
+    intraday_data.logger.setLevel(logging.WARNING)
+    intraday_data.ib = fake_ib_gateway.FakeIB(data_folderpath=None, latency=latency)
+    intraday_data.connect_ib(host="127.0.0.1", port=7497, client_id=1)
+    intraday_data.pacing_scheduler = intraday_data.PacingScheduler(max_requests=10 ** 9, max_contract_requests=10 ** 9,
+                                                                   identical_request_interval=0.0)
+    pairs = get_benchmark_pairs(number_of_symbols)
+
+    with tempfile.TemporaryDirectory() as folderpath:
+        folderpath += "/"
+        if scenario == "incremental":
+            intraday_data.download_recent_intraday_data(folderpath=folderpath, number_of_days=30, download_list=pairs,
+                                                        contract_type="forex",
+                                                        max_concurrent_requests=max_concurrent_requests)
+        run_metrics = intraday_data.configure_run_metrics()
+        start_time = time.perf_counter()
+        if scenario == "recent":
+            intraday_data.download_recent_intraday_data(folderpath=folderpath, number_of_days=30, download_list=pairs,
+                                                        contract_type="forex",
+                                                        max_concurrent_requests=max_concurrent_requests)
+        elif scenario == "historical":
+            intraday_data.download_historical_intraday_data(folderpath=folderpath, download_list=pairs,
+                                                            contract_type="forex",
+                                                            max_concurrent_requests=max_concurrent_requests)
+        elif scenario == "incremental":
+            intraday_data.download_recent_intraday_data(folderpath=folderpath, number_of_days=30, download_list=pairs,
+                                                        contract_type="forex",
+                                                        max_concurrent_requests=max_concurrent_requests,
+                                                        update_mode="append")
+        else:
+            assert False
+        seconds = time.perf_counter() - start_time
+    intraday_data.shutdown_post_processing()
+
+    summary = run_metrics.get_summary()
+    result_queue.put({"seconds": seconds, "requests": summary["requests"], "failed": summary["failed"],
+                      "bars": summary["bars"], "peak_rss_bytes": get_peak_rss_bytes()})
+    return None
+
+
+# peak resident set size of this process, None where the resource module is not available, e.g. on Windows
+def get_peak_rss_bytes() -> Optional[int]:
+    import sys
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024  # bytes on macOS, KiB elsewhere
+
+
+# end-to-end download throughput with a fake IB gateway answering every request after latency seconds.
+# Every scenario runs in a fresh process so that its peak RSS isn't inflated by earlier scenarios
+def benchmark_downloads(number_of_symbols: int = 20, latency: float = 0.05, max_concurrent_requests: int = 10,
+                        scenarios: Tuple[str, ...] = ("recent", "historical", "incremental")) -> None:
+    import multiprocessing
+
+    print("downloads of " + str(number_of_symbols) + " forex symbols, " + str(latency)
+          + " s latency, " + str(max_concurrent_requests) + " concurrent requests")
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        result_queue = context.Queue()
+        process = context.Process(target=run_download_scenario,
+                                  args=(scenario, number_of_symbols, latency, max_concurrent_requests, result_queue))
+        process.start()
+        result = result_queue.get()
+        process.join()
+        assert result["failed"] == 0, scenario + " benchmark had failed requests"
+        if result["peak_rss_bytes"] is None:
+            peak_rss = "n/a"
+        else:
+            peak_rss = format(result["peak_rss_bytes"] / 1024 ** 2, ".0f") + " MiB"
+        print("  " + scenario.ljust(11) + " " + format(result["seconds"], ".3f") + " s  "
+              + format(number_of_symbols / result["seconds"], ",.1f") + " symbols/s  "
+              + format(result["bars"] / result["seconds"], ",.0f") + " bars/s  "
+              + str(result["requests"]) + " requests  peak RSS " + peak_rss)
+    return None
+
+
+def main() -> None:
+    benchmark_transform()
+    benchmark_csv_writer()
+    benchmark_downloads()
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import random
+from typing import Dict, List, Optional, Set, Tuple
+from ib_insync import BarData, BarDataList, Contract, ContractDetails, RequestError, util
+
+import intraday_data
+
+
+# in-process stand-in for TWS / IB Gateway, so that intraday_data.py can be run, measured and regression
+# tested without a live connection.
+# Historical bars of symbols recorded in data_folderpath, e.g. data/recent/AUDSGD_1_hour_5_D_.csv, are replayed
+# from the Amibroker csv files. Every other symbol gets a synthetic series, deterministic for each symbol
+# and time, from head_timestamp to now, so that multi-year backfills and incremental updates line up.
+# Synthetic markets are open from Sunday 18:00 to Friday 17:00 with a daily break from 17:00 to 18:00.
+# latency : seconds each request takes on average
+# pacing_error_rate : fraction of requests rejected with IB's pacing violation error 162
+# disconnect_rate : fraction of requests that drop the connection. Like ib_insync, requests then fail with
+#                   ConnectionError until connectAsync() is called, which TWS refuses for reconnect_delay seconds
+# empty_symbols : symbols IB knows but has no data for
+# missing_bar_rate : fraction of bars left out of each answer, like the holes IB sometimes has in its data
+# usage: intraday_data.ib = FakeIB(latency=0.05), then intraday_data.connect_ib() like main()
+class FakeIB:
+    def __init__(self, data_folderpath: Optional[str] = "./data/recent/", latency: float = 0.05,
+                 pacing_error_rate: float = 0.0, disconnect_rate: float = 0.0, reconnect_delay: float = 1.0,
+                 empty_symbols: Tuple[str, ...] = (), missing_bar_rate: float = 0.0,
+                 head_timestamp: datetime.datetime = datetime.datetime(2005, 1, 3), seed: int = 0) -> None:
+        self.RaiseRequestErrors = False
+        self.latency = latency
+        self.pacing_error_rate = pacing_error_rate
+        self.disconnect_rate = disconnect_rate
+        self.reconnect_delay = reconnect_delay
+        self.empty_symbols: Set[str] = set(empty_symbols)
+        self.missing_bar_rate = missing_bar_rate
+        self.head_timestamp = head_timestamp
+        self.random = random.Random(seed)
+        self.recorded_bars: Dict[str, List[BarData]] = {}
+        if data_folderpath is not None:
+            self.recorded_bars = read_recorded_bars(data_folderpath)
+        self.connected = False
+        self.disconnected_until = 0.0
+        self.next_request_id = 1
+        self.number_of_requests = 0
+        self.number_of_bars = 0
+
+    def connect(self, host: str = "127.0.0.1", port: int = 7497, clientId: int = 1, readonly: bool = False,
+                timeout: float = 4) -> "FakeIB":
+        self.connected = True
+        return self
+
+    async def connectAsync(self, host: str = "127.0.0.1", port: int = 7497, clientId: int = 1,
+                           readonly: bool = False, timeout: float = 4) -> "FakeIB":
+        if time_now() < self.disconnected_until:
+            raise ConnectionRefusedError("Connect call failed " + host + ":" + str(port))
+        return self.connect()
+
+    def disconnect(self) -> None:
+        self.connected = False
+        return None
+
+    def isConnected(self) -> bool:
+        return self.connected
+
+    def run(self, *awaitables, timeout: Optional[float] = None):
+        return util.run(*awaitables, timeout=timeout)
+
+    # symbol of contract the way the download lists name it, e.g. EURUSD for Forex('EURUSD')
+    @staticmethod
+    def get_symbol(contract: Contract) -> str:
+        return contract.pair() if contract.secType == "CASH" else contract.symbol
+
+    # wait for the simulated round trip, then apply injected faults
+    async def start_request_async(self) -> int:
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.number_of_requests += 1
+        if not self.connected:
+            raise ConnectionError("Not connected")
+        await asyncio.sleep(self.latency * (0.5 + self.random.random()))
+        if not self.connected:
+            raise ConnectionError("Socket disconnect")
+        if self.random.random() < self.disconnect_rate:
+            self.connected = False
+            self.disconnected_until = time_now() + self.reconnect_delay
+            raise ConnectionError("Socket disconnect")
+        return request_id
+
+    # raise RequestError if RaiseRequestErrors is set, like ib_insync. Otherwise ib_insync returns no bars
+    def request_error(self, request_id: int, code: int, message: str) -> BarDataList:
+        if self.RaiseRequestErrors:
+            raise RequestError(request_id, code, message)
+        return BarDataList()
+
+    async def reqHistoricalDataAsync(self, contract: Contract, endDateTime, durationStr: str, barSizeSetting: str,
+                                     whatToShow: str, useRTH: bool, formatDate: int = 1, keepUpToDate: bool = False,
+                                     chartOptions: Optional[List] = None, timeout: float = 60) -> BarDataList:
+        request_id = await self.start_request_async()
+        if self.random.random() < self.pacing_error_rate:
+            return self.request_error(request_id, 162, "Historical Market Data Service error message:"
+                                                       "Historical data request pacing violation")
+
+        symbol = self.get_symbol(contract)
+        end_datetime = parse_end_date_time(endDateTime)
+        start_datetime = end_datetime - datetime.timedelta(seconds=intraday_data.duration_to_seconds(durationStr))
+        if symbol in self.empty_symbols:
+            bars = []
+        elif symbol in self.recorded_bars:
+            # recording is the answer to an open-ended request
+            bars = [bar for bar in self.recorded_bars[symbol]
+                    if endDateTime == "" or start_datetime <= bar.date < end_datetime]
+        else:
+            bars = make_synthetic_bars(symbol=symbol, start=max(start_datetime, self.head_timestamp),
+                                       end=end_datetime, bar_size=barSizeSetting,
+                                       with_volume=whatToShow == "TRADES")
+        if self.missing_bar_rate > 0:
+            bars = [bar for bar in bars if self.random.random() >= self.missing_bar_rate]
+        if not bars:
+            return self.request_error(request_id, 162, "Historical Market Data Service error message:"
+                                                       "HMDS query returned no data: " + symbol)
+        self.number_of_bars += len(bars)
+        bar_data_list = BarDataList(bars)
+        bar_data_list.contract = contract
+        bar_data_list.barSizeSetting = barSizeSetting
+        return bar_data_list
+
+    async def reqHeadTimeStampAsync(self, contract: Contract, whatToShow: str, useRTH: bool,
+                                    formatDate: int = 1) -> datetime.datetime:
+        await self.start_request_async()
+        symbol = self.get_symbol(contract)
+        if symbol in self.recorded_bars:
+            return self.recorded_bars[symbol][0].date
+        return self.head_timestamp
+
+    async def reqContractDetailsAsync(self, contract: Contract) -> List[ContractDetails]:
+        await self.start_request_async()
+        symbol = self.get_symbol(contract)
+        qualified = Contract.create(**util.dataclassNonDefaults(contract))
+        qualified.conId = get_synthetic_con_id(symbol)
+        return [ContractDetails(contract=qualified, longName=symbol, timeZoneId="UTC",
+                                tradingHours=get_trading_hours(datetime.date.today()),
+                                liquidHours=get_trading_hours(datetime.date.today()))]
+
+
+def time_now() -> float:
+    return asyncio.get_event_loop().time()
+
+
+# bars of the Amibroker csv files in data_folderpath, by symbol. volume is as written, i.e. 0 where IB reported -1
+def read_recorded_bars(data_folderpath: str) -> Dict[str, List[BarData]]:
+    import csv
+    import os
+
+    recorded_bars: Dict[str, List[BarData]] = {}
+    for filename in sorted(os.listdir(data_folderpath)):
+        if not filename.endswith(".csv"):
+            continue
+        with open(os.path.join(data_folderpath, filename), newline="") as f:
+            for row in csv.DictReader(f):
+                date = datetime.datetime.strptime(row["Date_YMD"] + " " + row["TIME"], "%Y%m%d %H:%M:%S")
+                recorded_bars.setdefault(row["ticker"], []).append(
+                    BarData(date=date, open=float(row["open"]), high=float(row["high"]), low=float(row["low"]),
+                            close=float(row["close"]), volume=float(row["volume"]), average=float(row["close"]),
+                            barCount=0))
+    for bars in recorded_bars.values():
+        bars.sort(key=lambda bar: bar.date)
+    return recorded_bars
+
+
+# end of requested window. endDateTime may carry a timezone after the time, e.g. "20151120 08:00:00 US/Eastern"
+def parse_end_date_time(end_date_time) -> datetime.datetime:
+    if isinstance(end_date_time, datetime.datetime):
+        return end_date_time.replace(tzinfo=None)
+    if end_date_time == "":
+        return datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    return datetime.datetime.strptime(end_date_time[:17], "%Y%m%d %H:%M:%S")
+
+
+def get_synthetic_con_id(symbol: str) -> int:
+    import zlib
+
+    return 100000 + zlib.crc32(symbol.encode()) % 900000
+
+
+# IB trading hours string of the synthetic market for a week from start_date in UTC, e.g.
+# "20200506:2200-20200507:2100;20200509:CLOSED". Bars are dated 18:00 to 17:00 in the local timezone of
+# this machine, the way TWS dates them, so sessions are converted to UTC
+def get_trading_hours(start_date: datetime.date) -> str:
+    import time
+
+    def to_utc(local_datetime: datetime.datetime) -> str:
+        return datetime.datetime.fromtimestamp(time.mktime(local_datetime.timetuple()),
+                                               datetime.timezone.utc).strftime("%Y%m%d:%H%M")
+
+    sessions = []
+    for day in range(7):
+        date = start_date + datetime.timedelta(days=day)
+        if date.weekday() in (4, 5):  # sessions open in the evening of Sunday to Thursday
+            sessions.append(date.strftime("%Y%m%d") + ":CLOSED")
+        else:
+            start = datetime.datetime.combine(date, datetime.time(18))
+            sessions.append(to_utc(start) + "-" + to_utc(start + datetime.timedelta(hours=23)))
+    return ";".join(sessions)
+
+
+# synthetic bars of symbol starting from start up to end when the market is open.
+# Prices are a deterministic function of symbol and time, so overlapping requests return the same bars.
+# volume and barCount are -1 unless with_volume, like IB reports MIDPOINT bars
+def make_synthetic_bars(symbol: str, start: datetime.datetime, end: datetime.datetime, bar_size: str,
+                        with_volume: bool) -> List[BarData]:
+    import numpy as np
+
+    step = intraday_data.bar_size_to_seconds(bar_size)
+    epoch = datetime.datetime(1970, 1, 1)
+    first = -(-int((start - epoch).total_seconds()) // step) * step
+    seconds = np.arange(first, int((end - epoch).total_seconds()), step, dtype=np.int64)
+    weekday = (seconds // 86400 + 3) % 7  # 1970-01-01 was a Thursday. Monday is 0
+    hour = seconds % 86400 // 3600
+    is_open = ((weekday <= 3) & (hour != 17)) | ((weekday == 4) & (hour < 17)) | ((weekday == 6) & (hour >= 18))
+    seconds = seconds[is_open]
+
+    base = 0.5 + get_synthetic_con_id(symbol) % 1000 / 500
+
+    def price(t):
+        noise = (t * 2654435761 + get_synthetic_con_id(symbol)) % 4294967296 / 4294967296 - 0.5
+        return base * (1 + 0.1 * np.sin(t / (90 * 86400) * 2 * np.pi) + 0.02 * np.sin(t / (5 * 86400))
+                       + 0.002 * noise)
+
+    open_prices = price(seconds)
+    close_prices = price(seconds + step)
+    spread = np.abs(price(seconds + step // 2) - open_prices)
+    high_prices = np.maximum(open_prices, close_prices) + spread
+    low_prices = np.minimum(open_prices, close_prices) - spread
+    volumes = (seconds // step % 997 + 1).astype(np.float64) if with_volume else np.full(len(seconds), -1.0)
+
+    dates = seconds.astype("datetime64[s]").astype(datetime.datetime)
+    return [BarData(date=date, open=open_price, high=high_price, low=low_price, close=close_price,
+                    volume=volume, average=(high_price + low_price) / 2, barCount=int(volume))
+            for date, open_price, high_price, low_price, close_price, volume
+            in zip(dates.tolist(), open_prices.round(6).tolist(), high_prices.round(6).tolist(),
+                   low_prices.round(6).tolist(), close_prices.round(6).tolist(), volumes.tolist())]
@@ -1,9 +1,25 @@
-from typing import Dict, List
+import asyncio
+import collections
+import contextlib
+import datetime
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 from ib_insync import *
 
 ib = IB()
 # util.startLoop()  # uncomment this line when in a notebook
 logger = None  # see logger_configuration() for global variable initialisation
+ib_pool = None  # see connect_ib_pool(). Requests use ib when no pool is connected
+bar_cache = None  # see configure_bar_cache(). Every request goes to IB when no cache is configured
+post_processing_executor = None  # see configure_post_processing(). Post-processing runs in threads when None
+post_processing_max_pending_writes = 20
+run_metrics = None  # see configure_run_metrics(). No metrics are collected when None
+contract_cache = None  # see configure_contract_cache(). Contracts are resolved by IB on every request when None
+empty_result_history = None  # see configure_empty_result_history(). Empty results aren't tracked when None
+quality_report_folderpath = None  # see configure_quality_gate(). Downloaded bars aren't checked when None
+quality_gate_max_gap_requests = 3
+quality_gate_unfilled_gaps: Set[str] = set()  # see configure_quality_gate()
+daemon_status: Dict = {}  # see run_daemon_async(). Served as JSON by serve_daemon_status_async()
 
 
 # configure logger to log to file and print out to console
@@ -44,16 +60,16 @@ def logger_configuration() -> None:
     return None
 
 
-# clean 'volume' column
-def clean_volume_column(volume_str: str) -> str:
-    volume = float(volume_str)
-    output = volume
-    if volume < 0:
-        output = 0
-    else:
-        output = volume
+# date column of downloaded bars as numpy datetime64[s] array in TWS timezone
+def get_bar_dates(df):
+    import pandas as pd
 
-    return str(output)
+    dates = df['date']
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates, cache=False)  # util.df() leaves date column as objects for some bars
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)  # keep wall clock time of TWS timezone
+    return dates.to_numpy(dtype='datetime64[s]')
 
 
 # transform downloaded intraday data from ib into format that can be imported by Amibroker as csv files
@@ -62,29 +78,44 @@ def clean_volume_column(volume_str: str) -> str:
 # ticker_value is value for column "Ticker"
 # return transformed dataframe
 def transform_intraday_ib(df, fullname_value: str, ticker_value: str):
-    # import os
+    import numpy as np
+    import pandas as pd
 
     # ensure df contains valid columns
     assert (('open' in df) and ('close' in df) and ('high' in df) and ('low' in df))
-    # assert (['open', 'close', 'high', 'low'] in df)
-    full_name = fullname_value
-    ticker = ticker_value
-
-    df["full_name"] = full_name
-    df["ticker"] = ticker
-
-    # split existing date column into 2 columns Date_YMD, TIME
-    df['date'] = df['date'].astype(str)  # convert to string first to use .str()
-    df[['Date_YMD', 'TIME']] = df['date'].str.split(' ', n=1, expand=True)
-    # drop unwanted columns.
-    df = df.drop(["date", "barCount", "average"], axis='columns')
-    # shift column order
-    df = df[['full_name', 'ticker', 'Date_YMD', 'TIME', 'open', 'high', 'low', 'close', 'volume']]
-    # transform Date_YMD from 2017-04-18 to 20170418
-    df['Date_YMD'] = df['Date_YMD'].str.replace("-", "")
+
+    dates = get_bar_dates(df)
+
+    # Date_YMD as integer 20170418, computed from the datetime64 values
+    days = dates.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    date_ymd = (months.astype('datetime64[Y]').astype(np.int64) + 1970) * 10000 \
+        + (months.astype(np.int64) % 12 + 1) * 100 \
+        + (days - months).astype(np.int64) + 1
+
+    # TIME as 08:00:00. Intraday bars only have a few distinct times of day, so format those once
+    # and store TIME as categorical codes into them
+    seconds_of_day = (dates - days).astype(np.int64)
+    unique_seconds, codes = np.unique(seconds_of_day, return_inverse=True)
+    time_hms = pd.Categorical.from_codes(codes.reshape(-1), categories=[
+        "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60) for seconds in unique_seconds.tolist()])
+
     # clean 'volume' column. Many -ve values which are nonsense. Make to minimum 0
-    df['volume'] = df['volume'].apply(clean_volume_column)
-    return df
+    # written as "0" for negative volumes and as the float otherwise, same as the csv files written so far
+    volume = df['volume'].to_numpy(dtype=np.float64)
+    volume_cleaned = volume.astype(object)
+    volume_cleaned[volume < 0] = 0
+
+    # single projection into the Amibroker column order
+    return pd.DataFrame({'full_name': fullname_value,
+                         'ticker': ticker_value,
+                         'Date_YMD': date_ymd,
+                         'TIME': time_hms,
+                         'open': df['open'].to_numpy(),
+                         'high': df['high'].to_numpy(),
+                         'low': df['low'].to_numpy(),
+                         'close': df['close'].to_numpy(),
+                         'volume': volume_cleaned})
 
 
 # get history of symbol list to download intraday history from Interactive Brokers
@@ -137,89 +168,2077 @@ def get_symbol_list(symbol: str, bar_size: str, what_to_show: str, duration: str
     return symbol_list
 
 
-# download intraday data from Interactive Brokers
-# contract_type can be "forex" or "cfd"
-def download_intraday_data_to_csv(symbol_list: List[Dict], contract_type: str,
-                                  csv_folderpath: str, print_start_date="no") -> None:
-    import traceback
-    import datetime
-    # import logging
-    # index = 0
-    # for index in range(0, 1):
-    # for index in range(9, len(symbol_list)):
-    for index in range(0, len(symbol_list)):
-        # print(df[['date', 'open', 'high', 'low', 'close']])
-        if symbol_list[index]["endDateTime"] != "":
-            csv_filename = symbol_list[index]["Symbol"] + '_' + symbol_list[index]["barSizeSetting"] \
-                           + '_' + symbol_list[index]["durationStr"] \
-                           + '_' + symbol_list[index]["endDateTime"] \
-                           + ".csv"
-        elif symbol_list[index]["endDateTime"] == "":
-            today_date_yyyymmdd = datetime.datetime.today().strftime('%Y-%m-%d')
-            if print_start_date == "yes":
-                start_date = "download" + today_date_yyyymmdd
+# build csv filepath of downloaded data from request parameters in symbol_dict
+# print_start_date = "yes" to append today's date to filename of open-ended requests
+def get_csv_filepath(symbol_dict: Dict, csv_folderpath: str, print_start_date="no") -> str:
+    if symbol_dict["endDateTime"] != "":
+        csv_filename = symbol_dict["Symbol"] + '_' + symbol_dict["barSizeSetting"] \
+                       + '_' + symbol_dict["durationStr"] \
+                       + '_' + symbol_dict["endDateTime"] \
+                       + ".csv"
+    else:
+        today_date_yyyymmdd = datetime.datetime.today().strftime('%Y-%m-%d')
+        if print_start_date == "yes":
+            start_date = "download" + today_date_yyyymmdd
+        else:
+            start_date = ""
+
+        csv_filename = symbol_dict["Symbol"] + '_' + symbol_dict["barSizeSetting"] \
+                       + '_' + symbol_dict["durationStr"] \
+                       + '_' + start_date \
+                       + ".csv"
+
+    csv_filename = csv_filename.replace(" ", "_")
+    csv_filename = csv_filename.replace(":", "_")
+    return csv_folderpath + csv_filename
+
+
+# contract of symbol_dict, qualified with conId if it is in the contract cache
+# contract_type can be "forex", "cfd", "index" or "cont_futures"
+def get_contract(symbol_dict: Dict, contract_type: str) -> Contract:
+    if contract_cache is not None:
+        contract = contract_cache.get_contract(ContractCache.get_key(symbol_dict=symbol_dict,
+                                                                     contract_type=contract_type))
+        if contract is not None:
+            return contract
+    return build_contract(symbol_dict=symbol_dict, contract_type=contract_type)
+
+
+# build ib_insync contract of symbol_dict
+# contract_type can be "forex", "cfd", "index" or "cont_futures"
+def build_contract(symbol_dict: Dict, contract_type: str) -> Contract:
+    if contract_type == "forex":
+        # SMART is the default exchange of get_symbol_list(). Forex pairs trade on IDEALPRO
+        contract = Forex(symbol_dict["Symbol"],
+                         exchange=symbol_dict["Exchange"] if symbol_dict["Exchange"] != "SMART" else "IDEALPRO")
+    elif contract_type == "cfd":
+        contract = CFD(symbol=symbol_dict["Symbol"],
+                       exchange=symbol_dict["Exchange"],
+                       currency=symbol_dict["Currency"])
+    elif contract_type == "index":
+        contract = Index(symbol=symbol_dict["Symbol"],
+                         exchange=symbol_dict["Exchange"],
+                         currency=symbol_dict["Currency"])
+    elif contract_type == "cont_futures":
+        contract = Contract(symbol=symbol_dict["Symbol"],
+                            secType='CONTFUT',
+                            exchange=symbol_dict["Exchange"],
+                            currency=symbol_dict["Currency"],
+                            includeExpired=True)
+    else:
+        raise Exception(F"invalid contract parameter {contract_type}")
+    return contract
+
+
+# columns of bar rows passed from the download stage to the post-processing stage, same as util.df(bars)
+bar_row_columns: List[str] = ["date", "open", "high", "low", "close", "volume", "average", "barCount"]
+
+
+# downloaded bars as plain tuples, which are much cheaper to send to a worker process than BarData objects
+def get_bar_rows(bars) -> List[Tuple]:
+    return [(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.average, bar.barCount)
+            for bar in bars]
+
+
+# frame of bar rows in the shape returned by util.df(bars)
+def get_bar_frame(rows: List[Tuple]):
+    import pandas as pd
+
+    return pd.DataFrame.from_records(rows, columns=bar_row_columns)
+
+
+# add value to metric key of metrics. metrics is None when the caller doesn't collect metrics
+def add_metric(metrics: Optional[Dict], key: str, value) -> None:
+    if metrics is not None:
+        metrics[key] = metrics.get(key, 0) + value
+    return None
+
+
+# columns of Amibroker csv files, as written by transform_intraday_ib() and to_csv()
+amibroker_csv_columns: List[str] = ["full_name", "ticker", "Date_YMD", "TIME", "open", "high", "low", "close",
+                                    "volume"]
+
+
+# wall clock date and time of a bar date in TWS timezone, same as get_bar_dates()
+def get_bar_datetime(date) -> datetime.datetime:
+    if isinstance(date, datetime.datetime):
+        return date.replace(tzinfo=None)
+    return datetime.datetime(date.year, date.month, date.day)  # daily bars
+
+
+# price as to_csv() writes a float64 column: shortest repr, empty if NaN
+def format_csv_float(value) -> str:
+    value = float(value)
+    return repr(value) if value == value else ""
+
+
+# write bar rows from get_bar_rows() to text file f in Amibroker format, batch_size rows at a time.
+# Lines are the same as transform_intraday_ib() and to_csv() write, but no DataFrame is built,
+# so memory use doesn't grow with number of bars beyond the rows themselves
+def write_bar_rows_to_csv_file(rows: Iterable[Tuple], fullname_value: str, ticker_value: str, f,
+                               batch_size: int = 10000) -> None:
+    import csv
+    import io
+    import itertools
+    import os
+
+    # to_csv() quotes names containing separators the same way
+    prefix = io.StringIO()
+    csv.writer(prefix, lineterminator="").writerow([fullname_value, ticker_value, ""])
+    line_format = prefix.getvalue().replace("%", "%%") + "%d%02d%02d,%02d:%02d:%02d,%s,%s,%s,%s,%s" + os.linesep
+
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            break
+        lines = []
+        for date, open_price, high_price, low_price, close_price, volume, average, bar_count in batch:
+            date = get_bar_datetime(date)
+            # clean volume. Many -ve values which are nonsense. Written as "0", same as transform_intraday_ib()
+            lines.append(line_format % (date.year, date.month, date.day, date.hour, date.minute, date.second,
+                                        format_csv_float(open_price), format_csv_float(high_price),
+                                        format_csv_float(low_price), format_csv_float(close_price),
+                                        "0" if volume < 0 else format_csv_float(volume)))
+        f.write("".join(lines))
+    return None
+
+
+# write bar rows from get_bar_rows() to csv file in Amibroker format
+# metrics : dict to add write_seconds and bytes_written to, see add_metric()
+def write_bars_to_csv(rows: Iterable[Tuple], symbol_dict: Dict, csv_filepath: str,
+                      metrics: Optional[Dict] = None) -> None:
+    import os
+
+    start = time.perf_counter()
+    # write next to the file and swap it in, so an interrupted write never leaves a truncated csv file
+    tmp_filepath = csv_filepath + ".tmp"
+    with open(tmp_filepath, "w", encoding="utf-8", newline="") as f:
+        f.write(",".join(amibroker_csv_columns) + os.linesep)
+        write_bar_rows_to_csv_file(rows=rows, fullname_value=symbol_dict["FullName"],
+                                   ticker_value=symbol_dict["Symbol"], f=f)
+    os.replace(tmp_filepath, csv_filepath)
+    add_metric(metrics, "write_seconds", time.perf_counter() - start)
+    add_metric(metrics, "bytes_written", os.path.getsize(csv_filepath))
+    return None
+
+
+# number of seconds in IB bar size setting, e.g. "1 hour" -> 3600
+def bar_size_to_seconds(bar_size: str) -> int:
+    unit_seconds = {"sec": 1, "secs": 1, "min": 60, "mins": 60, "hour": 3600, "hours": 3600,
+                    "day": 86400, "days": 86400, "week": 604800, "month": 2592000}
+    number, unit = bar_size.split(" ")
+    return int(number) * unit_seconds[unit]
+
+
+# number of seconds in IB duration string, e.g. "360 D" -> 31104000. Months and years are counted as 30 and 365 days
+def duration_to_seconds(duration: str) -> int:
+    unit_seconds = {"S": 1, "D": 86400, "W": 7 * 86400, "M": 30 * 86400, "Y": 365 * 86400}
+    number, unit = duration.split(" ")
+    return int(number) * unit_seconds[unit]
+
+
+# read date and time of last bar of Amibroker csv file written by write_bars_to_csv().
+# Seeks backwards from end of file so that only the last few kB are read, however long the file is.
+# return (datetime of last bar, byte offset where its line starts), or None if file is missing, has no bars
+# or its last line can't be parsed, e.g. cut short by an interrupted append. The file is then replaced
+def read_last_bar(csv_filepath: str, block_size: int = 4096) -> Optional[Tuple[datetime.datetime, int]]:
+    import os
+
+    if not os.path.isfile(csv_filepath):
+        return None
+
+    with open(csv_filepath, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        # ignore trailing line breaks
+        position = end
+        tail = b""
+        while True:
+            read_from = max(0, position - block_size)
+            f.seek(read_from)
+            tail = f.read(position - read_from) + tail
+            position = read_from
+            stripped = tail.rstrip(b"\r\n")
+            # need the line break in front of last line, unless the whole file has been read
+            if b"\n" in stripped or position == 0:
+                break
+
+    line_start = stripped.rfind(b"\n") + 1
+    try:
+        last_line = stripped[line_start:].decode().split(",")
+        if len(last_line) < 4 or last_line[2] == "Date_YMD":
+            return None  # header only
+        last_bar_datetime = datetime.datetime.strptime(last_line[2] + " " + last_line[3], "%Y%m%d %H:%M:%S")
+    except ValueError as e:
+        logger.warning("Can't read last bar of " + csv_filepath + ", downloading whole window: " + str(e))
+        return None
+    return last_bar_datetime, position + line_start
+
+
+# IB duration string from last_bar_datetime until now, including the last bar again because it may
+# have been incomplete when it was downloaded.
+# Dates of intraday bars are in TWS timezone, so this assumes the script runs in the timezone of TWS.
+# return None if the gap is longer than max_duration, e.g. "5 D" or "2 W", and the whole window has to be downloaded
+def get_incremental_duration(last_bar_datetime: datetime.datetime, bar_size: str, max_duration: str) -> Optional[str]:
+    import math
+
+    bar_seconds = bar_size_to_seconds(bar_size)
+    seconds = (datetime.datetime.now() - last_bar_datetime).total_seconds() + bar_seconds
+    seconds = max(seconds, 2 * bar_seconds)
+    if seconds > duration_to_seconds(max_duration):
+        return None
+    if seconds <= 86400:  # IB only accepts durations in seconds up to 1 day
+        return str(math.ceil(seconds)) + " S"
+    return str(math.ceil(seconds / 86400)) + " D"
+
+
+# append bar rows from get_bar_rows() to existing Amibroker csv file in place.
+# The overlapping last bar of the file is replaced by its downloaded version, bars older than it are dropped.
+# last_bar is the return value of read_last_bar()
+# metrics : dict to add write_seconds and bytes_written to, see add_metric()
+def append_bars_to_csv(rows: List[Tuple], symbol_dict: Dict, csv_filepath: str,
+                       last_bar: Tuple[datetime.datetime, int], metrics: Optional[Dict] = None) -> None:
+    import os
+
+    last_bar_datetime, last_line_offset = last_bar
+    rows = [row for row in rows if get_bar_datetime(row[0]) >= last_bar_datetime]
+    if not rows:
+        return None
+
+    start = time.perf_counter()
+    if get_bar_datetime(rows[0][0]) == last_bar_datetime:
+        os.truncate(csv_filepath, last_line_offset)
+    else:
+        with open(csv_filepath, "rb+") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    file_size = os.path.getsize(csv_filepath)
+    with open(csv_filepath, "a", encoding="utf-8", newline="") as f:
+        write_bar_rows_to_csv_file(rows=rows, fullname_value=symbol_dict["FullName"],
+                                   ticker_value=symbol_dict["Symbol"], f=f)
+    add_metric(metrics, "write_seconds", time.perf_counter() - start)
+    add_metric(metrics, "bytes_written", os.path.getsize(csv_filepath) - file_size)
+    return None
+
+
+# file extension of each columnar output format. "csv" is the Amibroker format written by write_bars_to_csv()
+columnar_file_extensions: Dict[str, str] = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+# typed frame of downloaded bars for columnar storage, indexed by datetime64 bar date.
+# Prices stay float64, float32 would round forex quotes. Negative volumes are clipped to 0
+def get_typed_bar_frame(df):
+    import numpy as np
+    import pandas as pd
+
+    return pd.DataFrame({"open": df["open"].to_numpy(dtype=np.float64),
+                         "high": df["high"].to_numpy(dtype=np.float64),
+                         "low": df["low"].to_numpy(dtype=np.float64),
+                         "close": df["close"].to_numpy(dtype=np.float64),
+                         "volume": np.clip(df["volume"].to_numpy(dtype=np.float64), 0, None),
+                         "average": df["average"].to_numpy(dtype=np.float64),
+                         "barCount": df["barCount"].to_numpy(dtype=np.int32)},
+                        index=pd.DatetimeIndex(get_bar_dates(df), name="date"))
+
+
+# folder of columnar files of symbol_dict, partitioned hive style so that pyarrow.dataset can discover it:
+# <folderpath>/<format>/bar_size=1_hour/symbol=EURUSD/year=2020/data.parquet
+def get_columnar_folderpath(symbol_dict: Dict, folderpath: str, output_format: str) -> str:
+    import os
+
+    return os.path.join(folderpath, output_format,
+                        "bar_size=" + symbol_dict["barSizeSetting"].replace(" ", "_"),
+                        "symbol=" + symbol_dict["Symbol"])
+
+
+# merge downloaded bars in df, as returned by util.df(), into columnar files, one file per symbol and year.
+# Bars already in a file are replaced by their downloaded version.
+# output_format "parquet" is zstd compressed. "arrow" is uncompressed Arrow IPC so that it can be memory-mapped
+# metrics : dict to add transform_seconds, write_seconds and bytes_written to, see add_metric()
+def write_bars_to_columnar(df, symbol_dict: Dict, folderpath: str, output_format: str,
+                           metrics: Optional[Dict] = None) -> None:
+    import os
+    import uuid
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    start = time.perf_counter()
+    df = get_typed_bar_frame(df)
+    transformed = time.perf_counter()
+    symbol_folderpath = get_columnar_folderpath(symbol_dict=symbol_dict, folderpath=folderpath,
+                                                output_format=output_format)
+    for year, df_year in df.groupby(df.index.year):
+        year_folderpath = os.path.join(symbol_folderpath, "year=" + str(year))
+        os.makedirs(year_folderpath, exist_ok=True)
+        filepath = os.path.join(year_folderpath, "data" + columnar_file_extensions[output_format])
+
+        if os.path.isfile(filepath):
+            if output_format == "parquet":
+                df_existing = pq.read_table(filepath).to_pandas()
             else:
-                start_date = ""
-
-            csv_filename = symbol_list[index]["Symbol"] + '_' + symbol_list[index]["barSizeSetting"] \
-                           + '_' + symbol_list[index]["durationStr"] \
-                           + '_' + start_date \
-                           + ".csv"
-
-        csv_filename = csv_filename.replace(" ", "_")
-        csv_filename = csv_filename.replace(":", "_")
-        csv_filepath = csv_folderpath + csv_filename
-
-        logger.info("Downloading " + str(index) + " " + csv_filename)
-        if contract_type == "forex":
-            contract = Forex(symbol_list[index]["Symbol"])
-        elif contract_type == "cfd":
-            contract = CFD(symbol=symbol_list[index]["Symbol"],
-                           exchange=symbol_list[index]["Exchange"],
-                           currency=symbol_list[index]["Currency"])
-        elif contract_type == "index":
-            contract = Index(symbol=symbol_list[index]["Symbol"],
-                             exchange=symbol_list[index]["Exchange"],
-                             currency=symbol_list[index]["Currency"])
-        elif contract_type == "cont_futures":
-            contract = Contract(symbol=symbol_list[index]["Symbol"],
-                                secType='CONTFUT',
-                                exchange=symbol_list[index]["Exchange"],
-                                currency=symbol_list[index]["Currency"],
-                                includeExpired=True)
+                with pa.memory_map(filepath) as source:
+                    df_existing = pa.ipc.open_file(source).read_pandas()
+            df_year = pd.concat([df_existing, df_year])
+            df_year = df_year[~df_year.index.duplicated(keep="last")]
+        table = pa.Table.from_pandas(df_year.sort_index(), preserve_index=True)
+
+        # write next to the file and swap it in, so readers never see half a file. The name is unique to this
+        # writer, and hidden from pyarrow.dataset discovery by its leading dot
+        tmp_filepath = os.path.join(year_folderpath, "." + os.path.basename(filepath) + "." + uuid.uuid4().hex
+                                    + ".tmp")
+        if output_format == "parquet":
+            pq.write_table(table, tmp_filepath, compression="zstd")
         else:
-            raise Exception(F"invalid contract parameter {{contract}}")
-        # documentation on reqHistoricalData()
-        # https://interactivebrokers.github.io/tws-api/historical_bars.html
-        # report traded price.
+            with pa.OSFile(tmp_filepath, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        os.replace(tmp_filepath, filepath)
+        add_metric(metrics, "bytes_written", os.path.getsize(filepath))
+    add_metric(metrics, "transform_seconds", transformed - start)
+    add_metric(metrics, "write_seconds", time.perf_counter() - transformed)
+    return None
+
+
+# read bars written by write_bars_to_columnar() of one symbol.
+# columns and years, e.g. ["close"] and [2019, 2020], limit what is read from disk
+def read_columnar_bars(folderpath: str, symbol: str, bar_size: str, output_format: str = "parquet",
+                       columns: Optional[List[str]] = None, years: Optional[List[int]] = None):
+    import pyarrow.dataset as ds
+
+    symbol_folderpath = get_columnar_folderpath(symbol_dict={"Symbol": symbol, "barSizeSetting": bar_size},
+                                                folderpath=folderpath, output_format=output_format)
+    dataset = ds.dataset(symbol_folderpath, format="parquet" if output_format == "parquet" else "ipc",
+                         partitioning="hive")
+    year_filter = None if years is None else ds.field("year").isin(years)
+    read_columns = None if columns is None else list(columns) + ["date"]
+    df = dataset.to_table(columns=read_columns, filter=year_filter).to_pandas()
+    if "date" in df.columns:  # pandas metadata only restores the index when every column is read
+        df = df.set_index("date")
+    return df.drop(columns=["year"], errors="ignore").sort_index()
+
+
+# session open and close of every bar at seconds, sorted and as returned by get_bar_dates(), in the same seconds.
+# sessions : (starts, ends) from get_session_calendar(). A bar belongs to the first session that closes after
+#            it, so missing bars within a session don't matter. Without sessions, a session opens with the first
+#            bar after a gap longer than source_seconds, i.e. after the market was closed, and closes after its
+#            last bar. A missing bar then splits a session
+def get_bar_sessions(seconds, source_seconds: int, sessions=None):
+    import numpy as np
+
+    if sessions is not None and len(sessions[0]):
+        starts, ends = sessions
+        index = np.minimum(np.searchsorted(ends, seconds, side="right"), len(ends) - 1)
+        return starts[index], np.maximum(ends[index], seconds + source_seconds)
+    session_open = np.r_[True, np.diff(seconds) > source_seconds]
+    session = np.cumsum(session_open) - 1
+    last_bars = np.r_[np.flatnonzero(session_open)[1:], len(seconds)] - 1
+    return seconds[session_open][session], (seconds[last_bars] + source_seconds)[session]
+
+
+# trading day of every bar at seconds, in seconds of its midnight, from the session opens and closes of
+# get_bar_sessions(). The trading day is the day a session closes on, like IB dates daily bars, e.g. Monday
+# for a session from Sunday 18:00 to Monday 17:00. Sessions longer than a day are cut every 24 hours
+def get_trading_day_seconds(seconds, opens, closes):
+    import numpy as np
+
+    day_closes = np.minimum(opens + ((seconds - opens) // 86400 + 1) * 86400, closes)
+    return (day_closes - 1) // 86400 * 86400
+
+
+# sessions of trading_hours in time_zone_id, see get_session_calendar(), from the day before the earliest bar
+# to the day after the latest bar of rows, or None if trading hours are unknown.
+# seconds are the dates of rows as returned by get_bar_dates()
+def get_row_session_calendar(rows: List[Tuple], seconds, trading_hours: Optional[str],
+                             time_zone_id: Optional[str]):
+    if not trading_hours or not time_zone_id or not len(seconds):
+        return None
+    epoch = datetime.datetime(1970, 1, 1)
+    first_date = (epoch + datetime.timedelta(seconds=int(seconds.min()))).date()
+    last_date = (epoch + datetime.timedelta(seconds=int(seconds.max()))).date()
+    first_bar_date = rows[0][0]
+    tws_tzinfo = first_bar_date.tzinfo if isinstance(first_bar_date, datetime.datetime) else None
+    # a day either side for sessions that start the day before in the timezone of the contract
+    return get_session_calendar(trading_hours=trading_hours, time_zone_id=time_zone_id,
+                                first_date=first_date - datetime.timedelta(days=1),
+                                last_date=last_date + datetime.timedelta(days=1), tws_tzinfo=tws_tzinfo)
+
+
+# aggregate downloaded bars in df, as returned by util.df() and sorted by date, into bars of bar_size,
+# e.g. "1 hour" bars into "4 hours" or "1 day" bars.
+# Bars are grouped within the trading sessions of get_bar_sessions(), so buckets follow the exchange's session
+# times whatever the TWS timezone and daylight saving time. Intraday buckets start at the session open plus
+# a multiple of bar_size and are dated with their start, or their first bar if later. A "1 day" bar covers
+# one trading day, see get_trading_day_seconds(), and is dated with it.
+# sessions : (starts, ends) from get_session_calendar(), or None to find sessions from gaps between bars
+# return frame with the columns of util.df(). volume and barCount stay -1 where IB reports none
+def resample_bars(df, source_bar_size: str, bar_size: str, sessions=None):
+    import numpy as np
+    import pandas as pd
+
+    source_seconds = bar_size_to_seconds(source_bar_size)
+    target_seconds = bar_size_to_seconds(bar_size)
+    assert source_seconds <= target_seconds <= 86400 and target_seconds % source_seconds == 0
+    if len(df) == 0:
+        return df[bar_row_columns]
+
+    seconds = get_bar_dates(df).astype(np.int64)
+    opens, closes = get_bar_sessions(seconds, source_seconds=source_seconds, sessions=sessions)
+    if target_seconds == 86400:
+        bucket_seconds = get_trading_day_seconds(seconds, opens=opens, closes=closes)
+    else:
+        # the first bar of a session may start off the grid of source bars, e.g. at 17:15 for forex
+        open_seconds = opens // source_seconds * source_seconds
+        bucket_seconds = open_seconds + (seconds - open_seconds) // target_seconds * target_seconds
+    starts = np.flatnonzero(np.r_[True, bucket_seconds[1:] != bucket_seconds[:-1]])
+    ends = np.r_[starts[1:], len(seconds)] - 1
+
+    if target_seconds == 86400:
+        dates = bucket_seconds[starts].astype("datetime64[s]")
+    else:
+        dates = np.maximum(bucket_seconds[starts], seconds[starts]).astype("datetime64[s]")
+    volume = df["volume"].to_numpy(dtype=np.float64)
+    has_volume = volume >= 0
+    volume_sum = np.add.reduceat(np.where(has_volume, volume, 0.0), starts)
+    average = df["average"].to_numpy(dtype=np.float64)
+    weighted_average = np.add.reduceat(np.where(has_volume, average * volume, 0.0), starts)
+    bar_count = df["barCount"].to_numpy(dtype=np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = np.where(volume_sum > 0, weighted_average / volume_sum,
+                           np.add.reduceat(average, starts) / (ends - starts + 1))
+    return pd.DataFrame({"date": dates,
+                         "open": df["open"].to_numpy(dtype=np.float64)[starts],
+                         "high": np.maximum.reduceat(df["high"].to_numpy(dtype=np.float64), starts),
+                         "low": np.minimum.reduceat(df["low"].to_numpy(dtype=np.float64), starts),
+                         "close": df["close"].to_numpy(dtype=np.float64)[ends],
+                         "volume": np.where(np.logical_or.reduceat(has_volume, starts), volume_sum, -1.0),
+                         "average": average,
+                         "barCount": np.where(np.logical_or.reduceat(bar_count >= 0, starts),
+                                              np.add.reduceat(np.clip(bar_count, 0, None), starts), -1)})
+
+
+# bar rows from get_bar_rows(), sorted by date, aggregated into bars of bar_size, see resample_bars().
+# Sessions come from trading_hours in time_zone_id, or from gaps between bars if they are None
+def resample_bar_rows(rows: List[Tuple], source_bar_size: str, bar_size: str, trading_hours: Optional[str] = None,
+                      time_zone_id: Optional[str] = None) -> List[Tuple]:
+    df = get_bar_frame(rows)
+    sessions = get_row_session_calendar(rows=rows, seconds=get_bar_dates(df).astype("int64"),
+                                        trading_hours=trading_hours, time_zone_id=time_zone_id)
+    df = resample_bars(df, source_bar_size=source_bar_size, bar_size=bar_size, sessions=sessions)
+    return list(zip(df["date"].dt.to_pydatetime(), *[df[column].tolist() for column in bar_row_columns[1:]]))
+
+
+# write bar rows from get_bar_rows() in every format of output_formats. Runs in the post-processing stage.
+# last_bar is the return value of read_last_bar() to append to existing csv file instead of replacing it
+# resampled_filepaths : csv filepath of each coarser bar size to derive from rows, e.g. {"1 day": ...}.
+#                       Coarser bars are written in every format of output_formats as well
+# trading_hours, time_zone_id : sessions of the contract to derive coarser bars in, see resample_bar_rows()
+# return metrics with transform_seconds, write_seconds and bytes_written
+def write_bars(rows: List[Tuple], symbol_dict: Dict, csv_filepath: str, output_formats: Tuple[str, ...],
+               last_bar: Optional[Tuple[datetime.datetime, int]] = None,
+               resampled_filepaths: Optional[Dict[str, str]] = None, trading_hours: Optional[str] = None,
+               time_zone_id: Optional[str] = None) -> Dict:
+    import os
+
+    metrics: Dict = {}
+    for bar_size, resampled_filepath in (resampled_filepaths or {}).items():
+        start = time.perf_counter()
+        resampled_rows = resample_bar_rows(rows, source_bar_size=symbol_dict["barSizeSetting"], bar_size=bar_size,
+                                           trading_hours=trading_hours, time_zone_id=time_zone_id)
+        add_metric(metrics, "transform_seconds", time.perf_counter() - start)
+        for key, value in write_bars(rows=resampled_rows, symbol_dict=dict(symbol_dict, barSizeSetting=bar_size),
+                                     csv_filepath=resampled_filepath, output_formats=output_formats).items():
+            add_metric(metrics, key, value)
+    if "csv" in output_formats:
+        if last_bar is None:
+            write_bars_to_csv(rows=rows, symbol_dict=symbol_dict, csv_filepath=csv_filepath, metrics=metrics)
+        else:
+            append_bars_to_csv(rows=rows, symbol_dict=symbol_dict, csv_filepath=csv_filepath, last_bar=last_bar,
+                               metrics=metrics)
+    # columnar formats need a DataFrame anyway, csv is written without one
+    if any(output_format in columnar_file_extensions for output_format in output_formats):
+        start = time.perf_counter()
+        df = get_bar_frame(rows)
+        add_metric(metrics, "transform_seconds", time.perf_counter() - start)
+        for output_format in output_formats:
+            if output_format in columnar_file_extensions:
+                write_bars_to_columnar(df=df, symbol_dict=symbol_dict, folderpath=os.path.dirname(csv_filepath),
+                                       output_format=output_format, metrics=metrics)
+    return metrics
+
+
+# sessions of IB trading hours string of a contract, e.g. "20200506:1715-20200507:1700;20200508:CLOSED",
+# or "20090507:0700-1830,1830-2330;20090508:CLOSED" as reported before TWS 970
+# return start and end of every session as naive datetimes in the timezone of the contract
+def parse_trading_hours(trading_hours: str) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    def parse_time(text: str, date: str) -> datetime.datetime:
+        if ":" in text:
+            date, text = text.split(":")
+        return datetime.datetime.strptime(date + text, "%Y%m%d%H%M")
+
+    sessions = []
+    for day in trading_hours.split(";"):
+        if day == "" or day.endswith("CLOSED"):
+            continue
+        date, time_ranges = day.split(":", 1)
+        for time_range in time_ranges.split(","):
+            start_text, end_text = time_range.split("-")
+            start = parse_time(start_text, date)
+            end = parse_time(end_text, date)
+            if end <= start:
+                end += datetime.timedelta(days=1)  # session past midnight in the format before TWS 970
+            sessions.append((start, end))
+    return sessions
+
+
+# naive datetimes in time_zone_id as seconds of wall clock time in TWS timezone, like get_bar_dates().
+# tws_tzinfo is the timezone of bar dates, or None if IB reports them naive in the timezone of this machine
+def get_wall_clock_seconds(datetimes: List[datetime.datetime], time_zone_id: str, tws_tzinfo=None):
+    import calendar
+    import numpy as np
+    import pandas as pd
+
+    index = pd.DatetimeIndex(datetimes).tz_localize(time_zone_id, ambiguous=np.zeros(len(datetimes), dtype=bool),
+                                                    nonexistent="shift_forward")
+    if tws_tzinfo is not None:
+        return index.tz_convert(tws_tzinfo).tz_localize(None).to_numpy(dtype="datetime64[s]").astype(np.int64)
+    epochs = index.tz_convert("UTC").tz_localize(None).to_numpy(dtype="datetime64[s]").astype(np.int64)
+    return np.array([calendar.timegm(time.localtime(epoch)) for epoch in epochs.tolist()], dtype=np.int64)
+
+
+# sessions from first_date to last_date, as arrays of start and end in seconds like get_bar_dates().
+# IB only reports trading hours of the next few days, so every day is assumed to trade like the same
+# weekday in trading_hours. Past holidays therefore show as gaps, which re-requests find closed
+def get_session_calendar(trading_hours: str, time_zone_id: str, first_date: datetime.date,
+                         last_date: datetime.date, tws_tzinfo=None):
+    weekday_dates: Dict[int, datetime.date] = {}
+    weekday_sessions: Dict[int, List[Tuple[datetime.timedelta, datetime.timedelta]]] = {}
+    for start, end in parse_trading_hours(trading_hours):
+        if weekday_dates.setdefault(start.weekday(), start.date()) == start.date():
+            weekday_sessions.setdefault(start.weekday(), []).append(
+                (start - datetime.datetime.combine(start.date(), datetime.time()), end - start))
+
+    starts: List[datetime.datetime] = []
+    ends: List[datetime.datetime] = []
+    for day in range((last_date - first_date).days + 1):
+        midnight = datetime.datetime.combine(first_date + datetime.timedelta(days=day), datetime.time())
+        for offset, length in weekday_sessions.get(midnight.weekday(), []):
+            starts.append(midnight + offset)
+            ends.append(midnight + offset + length)
+    return (get_wall_clock_seconds(starts, time_zone_id=time_zone_id, tws_tzinfo=tws_tzinfo),
+            get_wall_clock_seconds(ends, time_zone_id=time_zone_id, tws_tzinfo=tws_tzinfo))
+
+
+# start of every bar IB reports in sessions from starts to ends: the session start, then every multiple of
+# step_seconds after it, e.g. 17:15, 18:00, 19:00 for hourly bars of a forex session opening at 17:15
+def get_expected_bar_seconds(starts, ends, step_seconds: int):
+    import numpy as np
+
+    first_grid = (starts // step_seconds + 1) * step_seconds
+    counts = 1 + np.maximum(0, -(-(ends - first_grid) // step_seconds))
+    session = np.repeat(np.arange(len(starts)), counts)
+    number = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.unique(np.where(number == 0, starts[session], first_grid[session] + (number - 1) * step_seconds))
+
+
+# check bar rows from get_bar_rows() of one request in one vectorised pass. Runs in the post-processing stage.
+# Bars with zero or missing prices, or with high below low, open or close, or low above open or close, are
+# dropped. Of duplicate dates the last bar is kept. Intraday bars that pass are compared with the bars
+# expected in the sessions of trading_hours in time_zone_id, if given, to map missing bars between the
+# first and the last bar.
+# return rows that passed sorted by date, and quality report with the number of bars of each problem
+# and gaps as [first missing bar, last missing bar, number of missing bars]
+def check_bar_quality(rows: List[Tuple], bar_size: str, trading_hours: Optional[str] = None,
+                      time_zone_id: Optional[str] = None) -> Tuple[List[Tuple], Dict]:
+    import numpy as np
+
+    report: Dict = {"bars": len(rows), "passed": 0, "duplicates": 0, "unsorted": False, "zero_price": 0,
+                    "invalid_ohlc": 0, "calendar": False, "expected_bars": None, "missing_bars": 0,
+                    "off_calendar_bars": 0, "gaps": []}
+    if not rows:
+        return rows, report
+    df = get_bar_frame(rows)
+    seconds = get_bar_dates(df).astype(np.int64)
+    order = np.argsort(seconds, kind="stable")
+    seconds = seconds[order]
+    prices = df[["open", "high", "low", "close"]].to_numpy(dtype=np.float64)[order]
+    open_prices, high, low, close = prices.T
+    zero_price = np.isnan(prices).any(axis=1) | (prices == 0).any(axis=1)
+    with np.errstate(invalid="ignore"):
+        invalid_ohlc = ~zero_price & ((high < low) | (high < np.maximum(open_prices, close))
+                                      | (low > np.minimum(open_prices, close)))
+    valid = np.flatnonzero(~(zero_price | invalid_ohlc))
+    passed = valid[np.r_[seconds[valid][1:] != seconds[valid][:-1], True]] if len(valid) else valid
+    report.update(passed=len(passed), duplicates=int(len(seconds) - len(np.unique(seconds))),
+                  unsorted=bool(np.any(order != np.arange(len(order)))), zero_price=int(zero_price.sum()),
+                  invalid_ohlc=int(invalid_ohlc.sum()))
+    passed_rows = [rows[number] for number in order[passed]]
+
+    step_seconds = bar_size_to_seconds(bar_size)
+    if trading_hours and time_zone_id and step_seconds < 86400 and len(passed):
+        passed_seconds = seconds[passed]
+        epoch = datetime.datetime(1970, 1, 1)
+        starts, ends = get_row_session_calendar(rows=rows, seconds=passed_seconds, trading_hours=trading_hours,
+                                                time_zone_id=time_zone_id)
+        expected = get_expected_bar_seconds(starts, ends, step_seconds=step_seconds)
+        expected = expected[(expected >= passed_seconds[0]) & (expected <= passed_seconds[-1])]
+        missing = np.setdiff1d(expected, passed_seconds, assume_unique=True)
+        # consecutive expected bars that are missing form one gap
+        positions = np.searchsorted(expected, missing)
+        gap_starts = np.flatnonzero(np.r_[True, np.diff(positions) != 1]) if len(missing) else missing
+        gap_ends = np.r_[gap_starts[1:], len(missing)] - 1
+        report.update(calendar=True, expected_bars=len(expected), missing_bars=len(missing),
+                      off_calendar_bars=int(len(np.setdiff1d(passed_seconds, expected, assume_unique=True))),
+                      gaps=[[str(epoch + datetime.timedelta(seconds=int(missing[first]))),
+                             str(epoch + datetime.timedelta(seconds=int(missing[last]))), int(last - first + 1)]
+                            for first, last in zip(gap_starts, gap_ends)])
+    return passed_rows, report
+
+
+# requests of symbol_dict for just the gaps of a quality report from check_bar_quality(), one for each gap.
+# Each request ends after the last missing bar of its gap and lasts whole days, the smallest duration IB
+# accepts for every bar size
+def get_gap_request_list(symbol_dict: Dict, gaps: List[List]) -> List[Dict]:
+    import math
+
+    step = datetime.timedelta(seconds=bar_size_to_seconds(symbol_dict["barSizeSetting"]))
+    request_list = []
+    for first, last, number_of_bars in gaps:
+        end = datetime.datetime.fromisoformat(last) + step
+        days = math.ceil((end - datetime.datetime.fromisoformat(first)).total_seconds() / 86400)
+        request_list.append(dict(symbol_dict, endDateTime=end.strftime("%Y%m%d %H:%M:%S"),
+                                 durationStr=str(days) + " D"))
+    return request_list
+
+
+# rows with the rows of gap_rows dated within one of gaps added, unless rows already have a bar of that date
+def merge_gap_rows(rows: List[Tuple], gap_rows: List[Tuple], gaps: List[List]) -> List[Tuple]:
+    spans = [(datetime.datetime.fromisoformat(first), datetime.datetime.fromisoformat(last))
+             for first, last, number_of_bars in gaps]
+    dates = {get_bar_datetime(row[0]) for row in rows}
+    return rows + [row for row in gap_rows
+                   if get_bar_datetime(row[0]) not in dates
+                   and any(first <= get_bar_datetime(row[0]) <= last for first, last in spans)]
+
+
+# connect connection, ib or one of ib_pool, to TWS/Gateway. Its requests then raise RequestError with the IB
+# error code instead of returning empty bars, so that IB having no data can be told apart from a timeout
+async def connect_ib_async(connection: IB, host: str, port: int, client_id: int, readonly: bool = True,
+                           timeout: float = 4.0) -> None:
+    await connection.connectAsync(host, port, clientId=client_id, readonly=readonly, timeout=timeout)
+    connection.RaiseRequestErrors = True
+    return None
+
+
+# connect the global ib, see connect_ib_async()
+def connect_ib(host: str, port: int, client_id: int, readonly: bool = True) -> None:
+    ib.run(connect_ib_async(connection=ib, host=host, port=port, client_id=client_id, readonly=readonly))
+    return None
+
+
+# pool of IB connections with distinct client ids to the same TWS/Gateway.
+# Every connection has its own socket and message loop in TWS, so spreading requests over them raises the
+# throughput of one gateway. Broken connections are reconnected in the background and skipped meanwhile.
+# ib_factory creates the IB instances, e.g. to connect to a local fake gateway instead of TWS
+class IBConnectionPool:
+    def __init__(self, host: str, port: int, client_ids: List[int], readonly: bool = True,
+                 ib_factory: Callable[[], IB] = IB, timeout: float = 4.0) -> None:
+        assert len(client_ids) >= 1 and len(set(client_ids)) == len(client_ids)
+        self.host = host
+        self.port = port
+        self.client_ids = list(client_ids)
+        self.readonly = readonly
+        self.timeout = timeout
+        self.connections = [ib_factory() for _ in self.client_ids]
+        self.in_flight = [0 for _ in self.client_ids]  # requests in flight on each connection
+        self.reconnect_locks: Dict[int, asyncio.Lock] = {}
+        self.reconnecting = set()  # numbers of connections being reconnected in the background
+
+    # connect connection number unless it is connected already. return True if it is connected
+    async def connect_one_async(self, number: int) -> bool:
+        connection = self.connections[number]
+        async with self.reconnect_locks.setdefault(number, asyncio.Lock()):
+            if connection.isConnected():
+                return True
+            connection.disconnect()  # clear state of a broken connection
+            try:
+                await connect_ib_async(connection=connection, host=self.host, port=self.port,
+                                       client_id=self.client_ids[number], readonly=self.readonly,
+                                       timeout=self.timeout)
+            except Exception as e:
+                logger.warning("Client id " + str(self.client_ids[number]) + " failed to connect: " + repr(e))
+                return False
+        logger.info("Client id " + str(self.client_ids[number]) + " connected to " + self.host + ":" + str(self.port))
+        return True
+
+    # check every connection and reconnect broken ones. return number of connected connections
+    async def health_check_async(self) -> int:
+        results = await asyncio.gather(*[self.connect_one_async(number) for number in range(len(self.connections))])
+        return sum(results)
+
+    async def reconnect_in_background_async(self, number: int) -> None:
+        try:
+            await self.connect_one_async(number)
+        finally:
+            self.reconnecting.discard(number)
+
+    # connected connection with fewest requests in flight, held for the duration of the with block
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        for number, connection in enumerate(self.connections):
+            if not connection.isConnected() and number not in self.reconnecting:
+                self.reconnecting.add(number)
+                asyncio.ensure_future(self.reconnect_in_background_async(number))
+
+        connected = [number for number, connection in enumerate(self.connections) if connection.isConnected()]
+        if not connected:
+            if await self.health_check_async() == 0:
+                raise ConnectionError("No connection of the pool is connected to "
+                                      + self.host + ":" + str(self.port))
+            connected = [number for number, connection in enumerate(self.connections) if connection.isConnected()]
+
+        number = min(connected, key=lambda n: self.in_flight[n])
+        self.in_flight[number] += 1
         try:
-            bars = ib.reqHistoricalData(contract,
-                                        endDateTime=symbol_list[index]["endDateTime"],
-                                        durationStr=symbol_list[index]["durationStr"],
-                                        barSizeSetting=symbol_list[index]["barSizeSetting"],
-                                        whatToShow=symbol_list[index]["whatToShow"],
-                                        # useRTH=True)
-                                        useRTH=False)  # if use true, futures data download will be incomplete. Only during U.S hours
-        except Exception as e:
-            logger.info(traceback.format_exc())  # Logs the error appropriately.
-            continue  # skip current iteration and move to next for-loop iteration
-
-        df = util.df(bars)
-        df_new = transform_intraday_ib(df=df,
-                                       fullname_value=symbol_list[index]["FullName"],
-                                       ticker_value=symbol_list[index]["Symbol"])
-        df_new.to_csv(csv_filepath, index=False)
+            yield self.connections[number]
+        finally:
+            self.in_flight[number] -= 1
+
+    def disconnect(self) -> None:
+        for connection in self.connections:
+            connection.disconnect()
+        return None
+
+
+# connect a pool of number_of_connections IB connections with client ids first_client_id, first_client_id + 1, ...
+# Every later request is spread over the pool instead of going through the global ib connection
+def connect_ib_pool(host: str, port: int, number_of_connections: int, first_client_id: int = 1,
+                    readonly: bool = True, ib_factory: Callable[[], IB] = IB) -> IBConnectionPool:
+    global ib_pool
+
+    ib_pool = IBConnectionPool(host=host, port=port,
+                               client_ids=list(range(first_client_id, first_client_id + number_of_connections)),
+                               readonly=readonly, ib_factory=ib_factory)
+    number_connected = ib.run(ib_pool.health_check_async())
+    if number_connected == 0:
+        raise ConnectionError("Failed to connect to " + host + ":" + str(port))
+    logger.info(str(number_connected) + " of " + str(number_of_connections) + " connections connected")
+    return ib_pool
+
+
+# IB connection for the next request. Spreads requests over ib_pool when it is connected, else uses ib
+@contextlib.asynccontextmanager
+async def ib_connection():
+    if ib_pool is None:
+        yield ib
+    else:
+        async with ib_pool.connection() as connection:
+            yield connection
+
+
+# token bucket used to model IB's historical data pacing limits.
+# A token taken at time t only returns to the bucket at t + period, so no window of
+# period seconds ever holds more than capacity requests.
+# Tokens can also be recorded without enforcing the capacity, so that the bucket knows the history of a
+# window before it starts to limit it
+class TokenBucket:
+    def __init__(self, capacity: int, period: float) -> None:
+        assert capacity >= 1 and period > 0
+        self.capacity = capacity
+        self.period = period
+        self.taken: Deque[float] = collections.deque()  # time each token in use was taken
+
+    # return tokens taken more than one period ago to the bucket
+    def _refill(self, now: float) -> None:
+        while self.taken and self.taken[0] + self.period <= now:
+            self.taken.popleft()
+        return None
+
+    # seconds to wait before a token is available. 0 if a token is available now
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if len(self.taken) < self.capacity:
+            return 0.0
+        # tokens recorded beyond capacity have to be returned as well
+        return self.taken[len(self.taken) - self.capacity] + self.period - now
+
+    # take a token. enforce = False records it even if the bucket is empty
+    def consume(self, now: float, enforce: bool = True) -> None:
+        self._refill(now)
+        assert not enforce or len(self.taken) < self.capacity
+        self.taken.append(now)
+        return None
+
+
+# queues historical data requests so that they respect IB's pacing rules.
+# https://interactivebrokers.github.io/tws-api/historical_limitations.html
+#  - no identical historical data requests within 15 seconds
+#  - no 6 or more requests for the same contract, exchange and tick type within 2 seconds
+#  - no more than 60 requests within any 10 minute period
+# IB only enforces the 60 requests / 10 minutes rule strictly for bars of 30 seconds or less and
+# soft-throttles larger bars. The global bucket therefore applies to small bars always and to
+# larger bars once IB has reported a pacing violation in this session. Every request is recorded in
+# the global bucket, so that the requests already sent in the 10 minutes before count once it applies.
+class PacingScheduler:
+    def __init__(self, max_requests: int = 60, period: float = 600.0,
+                 max_contract_requests: int = 5, contract_period: float = 2.0,
+                 identical_request_interval: float = 15.0) -> None:
+        self.global_bucket = TokenBucket(capacity=max_requests, period=period)
+        self.max_contract_requests = max_contract_requests
+        self.contract_period = contract_period
+        self.contract_buckets: Dict[Tuple, TokenBucket] = {}
+        self.identical_request_interval = identical_request_interval
+        self.last_identical_request: Dict[Tuple, float] = {}
+        self.throttled = False  # True once IB has reported a pacing violation
+
+    @staticmethod
+    def is_small_bar(bar_size: str) -> bool:
+        return bar_size.endswith(("sec", "secs"))
+
+    @staticmethod
+    def contract_key(contract: Contract, symbol_dict: Dict) -> Tuple:
+        return (contract.symbol, contract.secType, contract.exchange, contract.currency,
+                symbol_dict["whatToShow"])
+
+    # wait until request of symbol_dict can be sent without breaking any pacing rule, then take its tokens
+    async def acquire(self, contract: Contract, symbol_dict: Dict) -> None:
+        contract_key = self.contract_key(contract=contract, symbol_dict=symbol_dict)
+        request_key = contract_key + (symbol_dict["endDateTime"], symbol_dict["durationStr"],
+                                      symbol_dict["barSizeSetting"])
+        contract_bucket = self.contract_buckets.setdefault(
+            contract_key, TokenBucket(capacity=self.max_contract_requests, period=self.contract_period))
+
+        while True:
+            now = time.monotonic()
+            use_global_bucket = self.throttled or self.is_small_bar(symbol_dict["barSizeSetting"])
+            wait = contract_bucket.wait_time(now)
+            if use_global_bucket:
+                wait = max(wait, self.global_bucket.wait_time(now))
+            if request_key in self.last_identical_request:
+                wait = max(wait, self.last_identical_request[request_key] + self.identical_request_interval - now)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        # no await between the checks above and taking the tokens, so concurrent callers can't overdraw
+        contract_bucket.consume(now)
+        self.global_bucket.consume(now, enforce=use_global_bucket)
+        self.last_identical_request[request_key] = now
+        return None
+
+    # IB has started throttling this session. Apply the global bucket to every later request
+    def report_pacing_violation(self) -> None:
+        if not self.throttled:
+            logger.warning("IB reported a pacing violation. Limiting to " + str(self.global_bucket.capacity)
+                           + " requests every " + str(self.global_bucket.period) + " seconds")
+        self.throttled = True
+        return None
+
+    # seconds until the global bucket lets another request through
+    def get_global_wait_time(self) -> float:
+        return self.global_bucket.wait_time(time.monotonic())
+
+
+pacing_scheduler = PacingScheduler()
+
+
+# on-disk cache of bars of sealed historical ranges, i.e. requests with a fixed endDateTime in the past.
+# Bars of such ranges never change, so they are served from disk instead of using IB pacing budget.
+# Open-ended requests with endDateTime == "" always go to IB.
+# Files are evicted least recently used first once the cache grows beyond max_bytes
+class BarCache:
+    def __init__(self, folderpath: str, max_bytes: int = 2 * 1024 ** 3) -> None:
+        import os
+
+        os.makedirs(folderpath, exist_ok=True)
+        self.folderpath = folderpath
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(symbol_dict: Dict) -> bool:
+        if symbol_dict["endDateTime"] == "":
+            return False
+        # endDateTime may carry a timezone after the time, e.g. "20151120 08:00:00 US/Eastern"
+        end_datetime = datetime.datetime.strptime(symbol_dict["endDateTime"][:17], "%Y%m%d %H:%M:%S")
+        return end_datetime < datetime.datetime.now()
+
+    # key of request identity: contract, bar size, whatToShow, useRTH and covered time range
+    @staticmethod
+    def get_key(contract: Contract, symbol_dict: Dict, use_rth: bool = False) -> str:
+        import hashlib
+        import json
+
+        contract_identity = [contract.conId] if contract.conId else \
+            [contract.symbol, contract.secType, contract.exchange, contract.currency]
+        identity = contract_identity + [symbol_dict["barSizeSetting"], symbol_dict["whatToShow"], use_rth,
+                                        symbol_dict["endDateTime"], symbol_dict["durationStr"]]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def get_filepath(self, key: str) -> str:
+        import os
+
+        return os.path.join(self.folderpath, key + ".pickle.gz")
+
+    # cached bars of key, or None on a miss
+    def get(self, key: str) -> Optional[List[BarData]]:
+        import gzip
+        import os
+        import pickle
+
+        filepath = self.get_filepath(key)
+        try:
+            with gzip.open(filepath, "rb") as f:
+                bars = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(filepath)  # modification time is the last use for LRU eviction
+        self.hits += 1
+        return bars
+
+    def put(self, key: str, bars: List[BarData]) -> None:
+        import gzip
+        import os
+        import pickle
+
+        filepath = self.get_filepath(key)
+        tmp_filepath = filepath + ".tmp"
+        with gzip.open(tmp_filepath, "wb", compresslevel=1) as f:
+            pickle.dump(list(bars), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, filepath)
+        self.evict()
+        return None
+
+    # remove least recently used files until cache is within max_bytes
+    def evict(self) -> None:
+        import os
+
+        entries = [entry for entry in os.scandir(self.folderpath) if entry.name.endswith(".pickle.gz")]
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+        return None
+
+    def log_statistics(self) -> None:
+        logger.info("Bar cache hits " + str(self.hits) + ", misses " + str(self.misses))
+        return None
+
+
+# serve sealed historical ranges from a bar cache in folderpath, capped at max_bytes
+def configure_bar_cache(folderpath: str, max_bytes: int = 2 * 1024 ** 3) -> BarCache:
+    global bar_cache
+
+    bar_cache = BarCache(folderpath=folderpath, max_bytes=max_bytes)
+    return bar_cache
+
+
+# on-disk cache of contracts qualified by IB, so that each symbol is resolved to its conId once per
+# ttl_seconds instead of on every request. Also keeps the time zone and trading hours of each contract.
+# Trading hours only cover the next few days, so entries expire after a day by default
+class ContractCache:
+    def __init__(self, filepath: str, ttl_seconds: float = 24 * 3600) -> None:
+        import json
+        import os
+
+        if os.path.dirname(filepath) != "":
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.filepath = filepath
+        self.ttl_seconds = ttl_seconds
+        self.entries: Dict[str, Dict] = {}
+        if os.path.isfile(filepath):
+            with open(filepath) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def get_key(symbol_dict: Dict, contract_type: str) -> str:
+        return "|".join([contract_type, symbol_dict["Symbol"], symbol_dict["Exchange"], symbol_dict["Currency"]])
+
+    # entry of key with contract fields, timeZoneId, tradingHours and liquidHours, or None if expired
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry["qualified"] > self.ttl_seconds:
+            return None
+        return entry
+
+    def get_contract(self, key: str) -> Optional[Contract]:
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return Contract.create(**entry["contract"])
+
+    def put(self, key: str, contract: Contract, contract_details: ContractDetails) -> None:
+        self.entries[key] = {"contract": util.dataclassNonDefaults(contract),
+                             "longName": contract_details.longName,
+                             "timeZoneId": contract_details.timeZoneId,
+                             "tradingHours": contract_details.tradingHours,
+                             "liquidHours": contract_details.liquidHours,
+                             "qualified": time.time()}
+        return None
+
+    def save(self) -> None:
+        import json
+        import os
+
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_filepath, self.filepath)
+        return None
+
+
+# qualify contracts once per ttl_seconds and keep them in a contract cache in filepath
+def configure_contract_cache(filepath: str, ttl_seconds: float = 24 * 3600) -> ContractCache:
+    global contract_cache
+
+    contract_cache = ContractCache(filepath=filepath, ttl_seconds=ttl_seconds)
+    return contract_cache
+
+
+# trading hours and timezone id of the contract of symbol_dict in the contract cache, or None, None if unknown
+def get_cached_trading_hours(symbol_dict: Dict, contract_type: str) -> Tuple[Optional[str], Optional[str]]:
+    if contract_cache is None:
+        return None, None
+    entry = contract_cache.get(ContractCache.get_key(symbol_dict=symbol_dict, contract_type=contract_type))
+    if entry is None:
+        return None, None
+    return entry["tradingHours"], entry["timeZoneId"]
+
+
+# number of consecutive downloads of each contract that returned no bars, kept across runs in a JSON file.
+# Contracts that keep returning nothing, e.g. HO, RB and PA at times, are demoted to the end of the download
+# queue once their streak reaches max_empty_streak, and promoted again by their next non-empty download
+class EmptyResultHistory:
+    def __init__(self, filepath: str, max_empty_streak: int = 3) -> None:
+        import json
+        import os
+
+        assert max_empty_streak >= 1
+        if os.path.dirname(filepath) != "":
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.filepath = filepath
+        self.max_empty_streak = max_empty_streak
+        self.streaks: Dict[str, int] = {}
+        if os.path.isfile(filepath):
+            with open(filepath) as f:
+                self.streaks = json.load(f)
+
+    def is_demoted(self, key: str) -> bool:
+        return self.streaks.get(key, 0) >= self.max_empty_streak
+
+    # status of a download as in new_request_metrics(). Failed downloads don't change the streak
+    def record(self, key: str, status: str) -> None:
+        if status == "empty":
+            self.streaks[key] = self.streaks.get(key, 0) + 1
+        elif status == "ok":
+            self.streaks.pop(key, None)
+        return None
+
+    def save(self) -> None:
+        import json
+        import os
+
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(self.streaks, f, indent=1, sort_keys=True)
+        os.replace(tmp_filepath, self.filepath)
+        return None
+
+
+def configure_empty_result_history(filepath: str, max_empty_streak: int = 3) -> EmptyResultHistory:
+    global empty_result_history
+
+    empty_result_history = EmptyResultHistory(filepath=filepath, max_empty_streak=max_empty_streak)
+    return empty_result_history
+
+
+# contract details of contract, empty if IB doesn't know the contract
+async def request_contract_details_async(contract: Contract,
+                                         semaphore: asyncio.Semaphore) -> List[ContractDetails]:
+    async with semaphore:
+        try:
+            async with ib_connection() as connection:
+                return await connection.reqContractDetailsAsync(contract)
+        except RequestError as e:
+            if e.code == 200:  # no security definition has been found for the request
+                return []
+            raise
+
+
+# resolve contracts of every entry of symbol_list that isn't in the contract cache yet to their conId.
+# Contract details of all of them are requested concurrently in one batch before any bars are requested.
+# Continuous futures stay CONTFUT with the conId of the front contract, so that their history spans rolls.
+# return entries of symbol_list that IB can't resolve to exactly one contract
+async def qualify_contracts_async(symbol_list: List[Dict], contract_type: str,
+                                  semaphore: asyncio.Semaphore) -> List[Dict]:
+    if contract_cache is None:
+        return []
+
+    keys = [ContractCache.get_key(symbol_dict=symbol_dict, contract_type=contract_type) for symbol_dict in symbol_list]
+    contracts: Dict[str, Contract] = {}
+    for key, symbol_dict in zip(keys, symbol_list):
+        if key not in contracts and contract_cache.get(key) is None:
+            contracts[key] = build_contract(symbol_dict=symbol_dict, contract_type=contract_type)
+    details_lists = await asyncio.gather(*[request_contract_details_async(contract=contract, semaphore=semaphore)
+                                           for contract in contracts.values()])
+
+    unresolved_keys = set()
+    for (key, contract), details_list in zip(contracts.items(), details_lists):
+        if len(details_list) != 1:
+            logger.error(("Unknown" if not details_list else "Ambiguous") + " contract " + key
+                         + ". Skipped")
+            unresolved_keys.add(key)
+            continue
+        qualified = details_list[0].contract
+        # keep the requested exchange and contract type. IB answers with the contract they resolve to
+        qualified.secType = contract.secType
+        qualified.exchange = contract.exchange
+        qualified.includeExpired = contract.includeExpired
+        if contract.secType == "CONTFUT":
+            qualified.lastTradeDateOrContractMonth = ""
+            qualified.localSymbol = ""
+        contract_cache.put(key=key, contract=qualified, contract_details=details_list[0])
+    if contracts:
+        logger.info("Qualified " + str(len(contracts) - len(unresolved_keys)) + " of " + str(len(contracts))
+                    + " contracts")
+        contract_cache.save()
+    return [symbol_dict for key, symbol_dict in zip(keys, symbol_list) if key in unresolved_keys]
+
+
+# metrics of one historical data request, filled in while the request goes through the pipeline
+#  queue_wait : seconds waiting for a pipeline slot, a request slot and the pacing scheduler
+#  latency : seconds of the IB round trip of the last attempt. None if served from cache or never sent
+#  transform_seconds, write_seconds, bytes_written : post-processing of the bars, see write_bars()
+#  retries : number of attempts sent again after a retryable error or lost connection
+#  status : "ok", "empty" if IB returned no bars, "failed"
+def new_request_metrics(symbol_dict: Dict, contract: Contract) -> Dict:
+    return {"symbol": symbol_dict["Symbol"], "exchange": contract.exchange,
+            "endDateTime": symbol_dict["endDateTime"], "durationStr": symbol_dict["durationStr"],
+            "barSizeSetting": symbol_dict["barSizeSetting"], "queue_wait": 0.0, "latency": None,
+            "cached": False, "retries": 0, "bars": 0, "transform_seconds": 0.0, "write_seconds": 0.0,
+            "bytes_written": 0, "status": "ok"}
+
+
+# metrics of every historical data request of a run, see new_request_metrics().
+# Each request is written to filepath as one JSON line as soon as it is done, so that slow or
+# empty symbols can be looked up even if the run doesn't finish. log_summary() ends the run with
+# latency percentiles and the slowest symbols
+class RunMetrics:
+    def __init__(self, filepath: Optional[str] = None) -> None:
+        import os
+
+        if filepath is not None and os.path.dirname(filepath) != "":
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.filepath = filepath
+        self.records: List[Dict] = []
+
+    def write_line(self, record: Dict) -> None:
+        import json
+
+        if self.filepath is not None:
+            with open(self.filepath, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return None
+
+    def record(self, metrics: Dict) -> None:
+        self.records.append(metrics)
+        self.write_line(dict(metrics, event="request"))
+        return None
+
+    # nearest-rank percentile of values, 0.0 if there are none
+    @staticmethod
+    def get_percentile(values: List[float], percent: float) -> float:
+        import math
+
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+    def get_percentiles(self, values: List[float]) -> Dict[str, float]:
+        return {"p" + str(percent): round(self.get_percentile(values, percent), 3) for percent in (50, 95, 99)}
+
+    # summary of the run. Latency percentiles only count requests that were sent to IB
+    def get_summary(self, number_of_slowest: int = 5) -> Dict:
+        latencies = [r["latency"] for r in self.records if r["latency"] is not None]
+        symbol_latencies: Dict[str, float] = collections.defaultdict(float)
+        exchange_latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        for r in self.records:
+            if r["latency"] is not None:
+                symbol_latencies[r["symbol"]] += r["latency"]
+                exchange_latencies[r["exchange"]].append(r["latency"])
+        slowest_symbols = sorted(symbol_latencies.items(), key=lambda item: item[1], reverse=True)
+        return {"event": "summary",
+                "requests": len(self.records),
+                "cached": sum(r["cached"] for r in self.records),
+                "failed": sum(r["status"] == "failed" for r in self.records),
+                "retries": sum(r["retries"] for r in self.records),
+                "bars": sum(r["bars"] for r in self.records),
+                "bytes_written": sum(r["bytes_written"] for r in self.records),
+                "transform_seconds": round(sum(r["transform_seconds"] for r in self.records), 3),
+                "write_seconds": round(sum(r["write_seconds"] for r in self.records), 3),
+                "latency": self.get_percentiles(latencies),
+                "queue_wait": self.get_percentiles([r["queue_wait"] for r in self.records]),
+                "latency_p50_by_exchange": {exchange: round(self.get_percentile(values, 50), 3)
+                                            for exchange, values in sorted(exchange_latencies.items())},
+                "slowest_symbols": [[symbol, round(latency, 3)]
+                                    for symbol, latency in slowest_symbols[:number_of_slowest]],
+                "empty_symbols": sorted({r["symbol"] for r in self.records if r["status"] == "empty"})}
+
+    # start a new summary, e.g. for the next refresh of run_daemon()
+    def clear(self) -> None:
+        self.records = []
+        return None
+
+    def log_summary(self, number_of_slowest: int = 5) -> Dict:
+        summary = self.get_summary(number_of_slowest=number_of_slowest)
+        self.write_line(summary)
+        logger.info("Requests " + str(summary["requests"]) + ", cached " + str(summary["cached"])
+                    + ", failed " + str(summary["failed"]) + ", retries " + str(summary["retries"])
+                    + ", bars " + str(summary["bars"]) + ", bytes written " + str(summary["bytes_written"]))
+        logger.info("Latency p50/p95/p99 " + "/".join(str(v) for v in summary["latency"].values())
+                    + " s, queue wait p50/p95/p99 " + "/".join(str(v) for v in summary["queue_wait"].values())
+                    + " s, transform " + str(summary["transform_seconds"])
+                    + " s, write " + str(summary["write_seconds"]) + " s")
+        if summary["slowest_symbols"]:
+            logger.info("Slowest symbols " + ", ".join(symbol + " " + str(latency) + " s"
+                                                        for symbol, latency in summary["slowest_symbols"]))
+        if summary["empty_symbols"]:
+            logger.info("No data for " + ", ".join(summary["empty_symbols"]))
+        return summary
+
+
+# collect per-request metrics of this run and write them as JSON lines to filepath, or keep them
+# in memory only if filepath is None
+def configure_run_metrics(filepath: Optional[str] = None) -> RunMetrics:
+    global run_metrics
+
+    run_metrics = RunMetrics(filepath=filepath)
+    return run_metrics
+
+
+# record metrics of a finished request, see new_request_metrics()
+def record_request_metrics(metrics: Dict) -> None:
+    if run_metrics is not None:
+        run_metrics.record(metrics)
     return None
 
 
-# download recent forex data in hourly bars
-# contract_type : "forex", "cfd", "index"
-def download_recent_intraday_data(folderpath, number_of_days: int, download_list, contract_type) -> None:
-    assert type(number_of_days) == int and (0 <= number_of_days <= 360)
+# IB errors of historical data requests that succeed when sent again later
+# 162 : historical market data service error. Only pacing violations pass. Others, e.g. no market data
+#       permissions, fail again on every attempt
+# 366 : no historical data query found for ticker id, e.g. request cancelled by IB
+def is_retryable_request_error(e: RequestError) -> bool:
+    return e.code == 366 or (e.code == 162 and "pacing violation" in e.message)
+
+
+# IB has no data for the requested period. Retrying won't change that
+def is_no_data_request_error(e: RequestError) -> bool:
+    return e.code == 162 and "query returned no data" in e.message
+
+
+# request historical bars of symbol_dict through the bar cache and the pacing scheduler.
+# Retryable errors, and lost connections of ib_pool, are sent again with exponential backoff up to
+# max_attempts times. Pacing violations are sent again once the 10 minute window of the pacing scheduler has room
+# metrics : dict from new_request_metrics() to fill in, or None
+async def request_historical_bars_async(contract: Contract, symbol_dict: Dict, semaphore: asyncio.Semaphore,
+                                        max_attempts: int = 6, backoff_seconds: float = 15.0,
+                                        metrics: Optional[Dict] = None) -> List[BarData]:
+    loop = asyncio.get_event_loop()
+    cache_key = None
+    if bar_cache is not None and bar_cache.is_cacheable(symbol_dict):
+        cache_key = bar_cache.get_key(contract=contract, symbol_dict=symbol_dict)
+        bars = await loop.run_in_executor(None, bar_cache.get, cache_key)
+        if bars is not None:
+            if metrics is not None:
+                metrics["cached"] = True
+            return bars
+
+    bars = await request_historical_bars_from_ib_async(contract=contract, symbol_dict=symbol_dict,
+                                                       semaphore=semaphore, max_attempts=max_attempts,
+                                                       backoff_seconds=backoff_seconds, metrics=metrics)
+    if cache_key is not None and bars:
+        await loop.run_in_executor(None, bar_cache.put, cache_key, bars)
+    return bars
+
+
+# request historical bars of symbol_dict from IB through the pacing scheduler
+async def request_historical_bars_from_ib_async(contract: Contract, symbol_dict: Dict, semaphore: asyncio.Semaphore,
+                                                max_attempts: int, backoff_seconds: float,
+                                                metrics: Optional[Dict] = None) -> List[BarData]:
+    for attempt in range(1, max_attempts + 1):
+        queued = time.monotonic()
+        pacing_violation = False
+        async with semaphore:
+            # pacing rules apply to the whole TWS session, so one scheduler covers every connection of the pool
+            await pacing_scheduler.acquire(contract=contract, symbol_dict=symbol_dict)
+            sent = time.monotonic()
+            add_metric(metrics, "queue_wait", sent - queued)
+            try:
+                async with ib_connection() as connection:
+                    # documentation on reqHistoricalData()
+                    # https://interactivebrokers.github.io/tws-api/historical_bars.html
+                    # report traded price.
+                    bars = await connection.reqHistoricalDataAsync(contract,
+                                                                   endDateTime=symbol_dict["endDateTime"],
+                                                                   durationStr=symbol_dict["durationStr"],
+                                                                   barSizeSetting=symbol_dict["barSizeSetting"],
+                                                                   whatToShow=symbol_dict["whatToShow"],
+                                                                   # useRTH=True)
+                                                                   useRTH=False)  # if use true, futures data download will be incomplete. Only during U.S hours
+                if bars or not connection.RaiseRequestErrors:
+                    return bars
+                # IB reports no data as error 162 when RaiseRequestErrors is set, see connect_ib_async(). No bars
+                # without error means ib_insync cancelled the request after its timeout, e.g. a long window
+                # queued behind others
+                if attempt == max_attempts:
+                    raise asyncio.TimeoutError("Historical data request of " + symbol_dict["Symbol"] + " "
+                                               + symbol_dict["endDateTime"] + " timed out")
+                error_message = "timeout"
+            except RequestError as e:
+                if is_no_data_request_error(e):
+                    return []
+                if not is_retryable_request_error(e) or attempt == max_attempts:
+                    raise
+                if "pacing violation" in e.message:
+                    pacing_scheduler.report_pacing_violation()
+                    pacing_violation = True
+                error_message = "error " + str(e.code) + ": " + e.message
+            except ConnectionError as e:
+                # only the pool reconnects in the background. ib stays disconnected until it is connected again,
+                # so waiting for it would only hold up the caller that reconnects it, e.g. run_daemon_async()
+                if ib_pool is None or attempt == max_attempts:
+                    raise
+                error_message = "connection error: " + str(e)
+            finally:
+                if metrics is not None:
+                    metrics["latency"] = time.monotonic() - sent
+
+        add_metric(metrics, "retries", 1)
+        # back off outside the semaphore so that other requests can use the slot meanwhile
+        delay = backoff_seconds * 2 ** (attempt - 1)
+        if pacing_violation:
+            # IB throttles until its 10 minute window has room again, which a backoff may not last for
+            delay = max(backoff_seconds, round(pacing_scheduler.get_global_wait_time(), 1))
+        logger.warning("Retrying " + symbol_dict["Symbol"] + " " + symbol_dict["endDateTime"]
+                       + " in " + str(delay) + " seconds after " + error_message)
+        await asyncio.sleep(delay)
+
+
+# run DataFrame building, transformation and serialisation of downloaded bars in max_workers processes,
+# so that CPU-bound pandas work neither delays the ib_insync event loop nor is limited to one core.
+# max_pending_writes bounds downloads waiting for post-processing. When the processes fall behind, new
+# requests wait instead of piling up bars in memory
+def configure_post_processing(max_workers: Optional[int] = None, max_pending_writes: int = 20) -> None:
+    import concurrent.futures
+
+    global post_processing_executor
+    global post_processing_max_pending_writes
+
+    assert max_pending_writes >= 1
+    shutdown_post_processing()
+    post_processing_executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    post_processing_max_pending_writes = max_pending_writes
+    return None
 
-    bar_size = "1 hour"
 
-    # can't show 'TRADES' for FOREX AND CFD. See https://interactivebrokers.github.io/tws-api/historical_bars.html
+def shutdown_post_processing() -> None:
+    global post_processing_executor
+
+    if post_processing_executor is not None:
+        post_processing_executor.shutdown()
+        post_processing_executor = None
+    return None
+
+
+# slots of the bounded buffer between download and post-processing stages. A download takes a slot before
+# its request and gives it back once its bars are written
+def get_pipeline_slots(max_concurrent_requests: int) -> asyncio.Semaphore:
+    return asyncio.Semaphore(max_concurrent_requests + post_processing_max_pending_writes)
+
+
+# run func(*args) in the post-processing stage
+async def post_process_async(func: Callable, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(post_processing_executor, func, *args)
+
+
+# lock of the columnar files of each symbol in each output folder, see post_process_write_async()
+columnar_write_locks: Dict[str, asyncio.Lock] = {}
+
+
+# run func(*args) in the post-processing stage, where it writes bars of symbol_dict next to csv_filepath in
+# output_formats. Columnar files of a symbol are read, merged and rewritten year by year, and chunks of one
+# symbol span the same years, so writes with columnar formats run one at a time for each symbol
+async def post_process_write_async(symbol_dict: Dict, csv_filepath: str, output_formats: Tuple[str, ...],
+                                   func: Callable, *args):
+    import os
+
+    if not any(output_format in columnar_file_extensions for output_format in output_formats):
+        return await post_process_async(func, *args)
+    key = os.path.join(os.path.dirname(csv_filepath), symbol_dict["Symbol"])
+    async with columnar_write_locks.setdefault(key, asyncio.Lock()):
+        return await post_process_async(func, *args)
+
+
+# sha256 of file contents
+def get_file_checksum(filepath: str) -> str:
+    import hashlib
+
+    checksum = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+# persistent state of every chunk of a long backfill job in an SQLite database, so that a job interrupted
+# by a lost TWS connection or a crash resumes with its unfinished chunks only.
+# A chunk is identified by its output filepath. Its state is "running" while it is downloaded, "done" once
+# its output is written, "no_data" if IB reported that it has no data for it and "failed" if it failed after
+# all retries. Chunks left "empty" by earlier versions, which included timed out requests, are downloaded again.
+# checksum is the sha256 of the chunk's csv file, so that a done chunk whose file was lost or changed
+# since is downloaded again. attempts counts downloads of the chunk over all runs of the job
+class JobManifest:
+    def __init__(self, filepath: str) -> None:
+        import os
+        import sqlite3
+
+        if os.path.dirname(filepath) != "":
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath, isolation_level=None)  # every update is committed at once
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, symbol TEXT,"
+                                " end_date_time TEXT, state TEXT, attempts INTEGER NOT NULL DEFAULT 0,"
+                                " checksum TEXT, earliest_bar TEXT, updated TEXT)")
+
+    # state, attempts, checksum and earliest_bar of chunk key, or None if the chunk was never started
+    def get(self, key: str) -> Optional[Dict]:
+        row = self.connection.execute("SELECT state, attempts, checksum, earliest_bar FROM chunks WHERE key = ?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        return {"state": row[0], "attempts": row[1], "checksum": row[2], "earliest_bar": row[3]}
+
+    def start(self, key: str, symbol_dict: Dict) -> None:
+        now = datetime.datetime.now().isoformat()
+        self.connection.execute("INSERT OR IGNORE INTO chunks (key, symbol, end_date_time) VALUES (?, ?, ?)",
+                                (key, symbol_dict["Symbol"], symbol_dict["endDateTime"]))
+        self.connection.execute("UPDATE chunks SET state = 'running', attempts = attempts + 1, checksum = NULL,"
+                                " earliest_bar = NULL, updated = ? WHERE key = ?", (now, key))
+        return None
+
+    # earliest_bar : date of earliest bar written, needed to resume stitched backfills
+    def finish(self, key: str, state: str, checksum: Optional[str] = None,
+               earliest_bar: Optional[datetime.datetime] = None) -> None:
+        assert state in ("done", "no_data", "failed")
+        now = datetime.datetime.now().isoformat()
+        self.connection.execute("UPDATE chunks SET state = ?, checksum = ?, earliest_bar = ?, updated = ?"
+                                " WHERE key = ?",
+                                (state, checksum, None if earliest_bar is None else earliest_bar.isoformat(),
+                                 now, key))
+        return None
+
+    def get_unfinished_count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM chunks WHERE state NOT IN ('done', 'no_data')"
+                                       ).fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+        return None
+
+    # delete the manifest of a completed job, so that the next job starts from scratch
+    def remove(self) -> None:
+        import os
+
+        self.close()
+        os.remove(self.filepath)
+        return None
+
+
+# True if chunk key of manifest was finished in a previous run and its csv file at filepath is unchanged
+async def is_chunk_done_async(manifest: JobManifest, key: str, filepath: str) -> bool:
+    import os
+
+    entry = manifest.get(key)
+    if entry is None or entry["state"] not in ("done", "no_data"):
+        return False
+    if entry["checksum"] is None:
+        return True  # no bars or no csv output
+    if not os.path.isfile(filepath):
+        return False
+    return await post_process_async(get_file_checksum, filepath) == entry["checksum"]
+
+
+# check every download with check_bar_quality() before it is written, and write a quality report of each
+# csv file to folderpath. The largest gaps are requested again, up to max_gap_requests per download.
+# Gaps IB had no bars for are kept in unfilled_gaps.json of folderpath and not requested again in later
+# runs, since closed sessions, e.g. holidays, and hours without trades never fill
+def configure_quality_gate(folderpath: str, max_gap_requests: int = 3) -> None:
+    import json
+    import os
+
+    global quality_report_folderpath
+    global quality_gate_max_gap_requests
+    global quality_gate_unfilled_gaps
+
+    assert max_gap_requests >= 0
+    os.makedirs(folderpath, exist_ok=True)
+    quality_report_folderpath = folderpath
+    quality_gate_max_gap_requests = max_gap_requests
+    quality_gate_unfilled_gaps = set()
+    if os.path.isfile(get_unfilled_gaps_filepath()):
+        with open(get_unfilled_gaps_filepath()) as f:
+            quality_gate_unfilled_gaps = set(json.load(f))
+    return None
+
+
+def get_unfilled_gaps_filepath() -> str:
+    import os
+
+    return os.path.join(quality_report_folderpath, "unfilled_gaps.json")
+
+
+def save_unfilled_gaps() -> None:
+    import json
+    import os
+
+    tmp_filepath = get_unfilled_gaps_filepath() + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(sorted(quality_gate_unfilled_gaps), f, indent=1)
+    os.replace(tmp_filepath, get_unfilled_gaps_filepath())
+    return None
+
+
+# data-quality gate of bar rows downloaded for symbol_dict, see check_bar_quality(). Sessions come from
+# the trading hours in the contract cache, so gaps are only mapped when it is configured.
+# Gaps are requested again from IB, bypassing the bar cache, and bars IB has for them are merged in.
+# Gaps that came back without bars are remembered and skipped from then on, see configure_quality_gate().
+# The report is written to quality_report_folderpath as report_name + ".json"
+# return rows that passed the checks, sorted by date
+async def quality_gate_async(rows: List[Tuple], contract: Contract, symbol_dict: Dict, contract_type: str,
+                             semaphore: asyncio.Semaphore, report_name: str) -> List[Tuple]:
+    import json
+    import os
+
+    contract_key = ContractCache.get_key(symbol_dict=symbol_dict, contract_type=contract_type)
+    trading_hours, time_zone_id = get_cached_trading_hours(symbol_dict=symbol_dict, contract_type=contract_type)
+    bar_size = symbol_dict["barSizeSetting"]
+    rows, report = await post_process_async(check_bar_quality, rows, bar_size, trading_hours, time_zone_id)
+
+    def get_gap_key(gap: List) -> str:
+        return contract_key + " " + bar_size + " " + gap[0] + " " + gap[1]
+
+    # largest gaps first
+    gaps = sorted([gap for gap in report["gaps"] if get_gap_key(gap) not in quality_gate_unfilled_gaps],
+                  key=lambda gap: gap[2], reverse=True)[:quality_gate_max_gap_requests]
+    gap_rows: List[Tuple] = []
+    number_of_unfilled_gaps = len(quality_gate_unfilled_gaps)
+    for gap, gap_dict in zip(gaps, get_gap_request_list(symbol_dict=symbol_dict, gaps=gaps)):
+        try:
+            rows_of_gap = get_bar_rows(await request_historical_bars_from_ib_async(contract=contract,
+                                                                                   symbol_dict=gap_dict,
+                                                                                   semaphore=semaphore,
+                                                                                   max_attempts=3,
+                                                                                   backoff_seconds=15.0))
+        except (RequestError, ConnectionError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to request gap of " + report_name + " ending " + gap_dict["endDateTime"]
+                           + ": " + str(e))
+            continue
+        first = datetime.datetime.fromisoformat(gap[0])
+        last = datetime.datetime.fromisoformat(gap[1])
+        if not any(first <= get_bar_datetime(row[0]) <= last for row in rows_of_gap):
+            quality_gate_unfilled_gaps.add(get_gap_key(gap))
+        gap_rows += rows_of_gap
+    if len(quality_gate_unfilled_gaps) != number_of_unfilled_gaps:
+        save_unfilled_gaps()
+    report["gap_requests"] = len(gaps)
+    report["refilled_bars"] = 0
+    if gap_rows:
+        rows, merged_report = await post_process_async(check_bar_quality,
+                                                       merge_gap_rows(rows, gap_rows, report["gaps"]),
+                                                       bar_size, trading_hours, time_zone_id)
+        report["refilled_bars"] = report["missing_bars"] - merged_report["missing_bars"]
+        report.update(missing_bars=merged_report["missing_bars"], gaps=merged_report["gaps"])
+
+    if report["bars"] != report["passed"] or report["missing_bars"] or report["refilled_bars"]:
+        logger.warning(report_name + ": dropped " + str(report["zero_price"]) + " zero price, "
+                       + str(report["invalid_ohlc"]) + " invalid OHLC and " + str(report["duplicates"])
+                       + " duplicate bars, refilled " + str(report["refilled_bars"]) + " bars, "
+                       + str(report["missing_bars"]) + " bars missing in " + str(len(report["gaps"])) + " gaps")
+    report = dict({"symbol": symbol_dict["Symbol"], "endDateTime": symbol_dict["endDateTime"],
+                   "durationStr": symbol_dict["durationStr"], "barSizeSetting": bar_size}, **report)
+    with open(os.path.join(quality_report_folderpath, report_name + ".json"), "w") as f:
+        json.dump(report, f, indent=1)
+    return rows
+
+
+# download one entry of symbol list and write it to csv file.
+# semaphore bounds the number of historical data requests in flight
+# pipeline_slots bounds downloads waiting for post-processing, see get_pipeline_slots()
+# update_mode = "overwrite" to download the whole durationStr window and replace the csv file,
+#               "append" to only download bars since the last bar of an existing csv file and append them
+# output_formats : any of "csv", "parquet", "arrow". See write_bars()
+# manifest : job manifest to skip entries finished in a previous run and record this one, or None
+# resample_bar_sizes : coarser bar sizes to derive from the downloaded bars into their own files, see resample_bars()
+# return True if the entry was downloaded, False if the request failed
+async def download_symbol_to_csv_async(index: int, symbol_dict: Dict, contract_type: str, csv_folderpath: str,
+                                       print_start_date: str, semaphore: asyncio.Semaphore,
+                                       pipeline_slots: asyncio.Semaphore, update_mode: str = "overwrite",
+                                       output_formats: Tuple[str, ...] = ("csv",),
+                                       manifest: Optional[JobManifest] = None,
+                                       resample_bar_sizes: Tuple[str, ...] = ()) -> bool:
+    import os
+    import traceback
+
+    assert update_mode in ("overwrite", "append")
+    assert manifest is None or update_mode == "overwrite"
+    assert not resample_bar_sizes or update_mode == "overwrite"  # coarser bars need whole sessions
+    csv_filepath = get_csv_filepath(symbol_dict=symbol_dict, csv_folderpath=csv_folderpath,
+                                    print_start_date=print_start_date)
+    resampled_filepaths = {bar_size: get_csv_filepath(symbol_dict=dict(symbol_dict, barSizeSetting=bar_size),
+                                                      csv_folderpath=csv_folderpath,
+                                                      print_start_date=print_start_date)
+                           for bar_size in resample_bar_sizes}
+    if manifest is not None and await is_chunk_done_async(manifest=manifest, key=csv_filepath,
+                                                          filepath=csv_filepath):
+        logger.info("Skipping " + str(index) + " " + os.path.basename(csv_filepath) + ", done in previous run")
+        return True
+    contract = get_contract(symbol_dict=symbol_dict, contract_type=contract_type)
+
+    # csv filename keeps the nominal duration, only the request is shortened
+    request_dict = symbol_dict
+    last_bar = None
+    if update_mode == "append" and "csv" in output_formats:
+        last_bar = read_last_bar(csv_filepath)
+    if last_bar is not None:
+        duration = get_incremental_duration(last_bar_datetime=last_bar[0],
+                                            bar_size=symbol_dict["barSizeSetting"],
+                                            max_duration=symbol_dict["durationStr"])
+        if duration is None:
+            last_bar = None  # file is older than the download window. Replace it
+        else:
+            request_dict = dict(symbol_dict, durationStr=duration)
+
+    metrics = new_request_metrics(symbol_dict=request_dict, contract=contract)
+    queued = time.monotonic()
+    async with pipeline_slots:
+        add_metric(metrics, "queue_wait", time.monotonic() - queued)
+        logger.info("Downloading " + str(index) + " " + os.path.basename(csv_filepath)
+                    + ("" if last_bar is None else " since " + str(last_bar[0])))
+        if manifest is not None:
+            manifest.start(key=csv_filepath, symbol_dict=symbol_dict)
+        try:
+            try:
+                bars = await request_historical_bars_async(contract=contract, symbol_dict=request_dict,
+                                                           semaphore=semaphore, metrics=metrics)
+            except Exception:
+                logger.info(traceback.format_exc())  # Logs the error appropriately.
+                metrics["status"] = "failed"
+                if manifest is not None:
+                    manifest.finish(key=csv_filepath, state="failed")
+                return False
+
+            metrics["bars"] = len(bars)
+            if not bars:
+                logger.warning("No data downloaded for " + os.path.basename(csv_filepath))
+                metrics["status"] = "empty"
+                if manifest is not None:
+                    manifest.finish(key=csv_filepath, state="no_data")
+                return True
+
+            # overlap transform and writing with the network waits of other requests
+            try:
+                rows = get_bar_rows(bars)
+                if quality_report_folderpath is not None:
+                    rows = await quality_gate_async(rows=rows, contract=contract, symbol_dict=request_dict,
+                                                    contract_type=contract_type, semaphore=semaphore,
+                                                    report_name=os.path.basename(csv_filepath)[:-len(".csv")])
+                trading_hours, time_zone_id = get_cached_trading_hours(symbol_dict=symbol_dict,
+                                                                       contract_type=contract_type)
+                metrics.update(await post_process_write_async(symbol_dict, csv_filepath, output_formats, write_bars,
+                                                              rows, symbol_dict, csv_filepath, output_formats,
+                                                              last_bar, resampled_filepaths, trading_hours,
+                                                              time_zone_id))
+                checksum = None
+                if manifest is not None and "csv" in output_formats:
+                    checksum = await post_process_async(get_file_checksum, csv_filepath)
+            except Exception:
+                logger.info(traceback.format_exc())
+                metrics["status"] = "failed"
+                if manifest is not None:
+                    manifest.finish(key=csv_filepath, state="failed")
+                return False
+            if manifest is not None:
+                manifest.finish(key=csv_filepath, state="done", checksum=checksum)
+        finally:
+            record_request_metrics(metrics)
+            # only refreshes of the latest bars count. Old history chunks are expected to be empty for young contracts
+            if empty_result_history is not None and symbol_dict["endDateTime"] == "":
+                empty_result_history.record(key=ContractCache.get_key(symbol_dict=symbol_dict,
+                                                                      contract_type=contract_type),
+                                            status=metrics["status"])
+    return True
+
+
+# download intraday data of every entry in symbol_list concurrently
+# max_concurrent_requests keeps number of requests in flight under IB's limit of
+# 50 simultaneous open historical data requests
+# update_mode : "overwrite" or "append". See download_symbol_to_csv_async()
+# output_formats : any of "csv", "parquet", "arrow". See write_bars()
+# manifest : job manifest to resume an interrupted job with, or None. See JobManifest
+# resample_bar_sizes : coarser bar sizes to derive from the downloaded bars, see resample_bars()
+# return entries of symbol_list that failed to download
+async def download_intraday_data_to_csv_async(symbol_list: List[Dict], contract_type: str,
+                                              csv_folderpath: str, print_start_date="no",
+                                              max_concurrent_requests: int = 10,
+                                              update_mode: str = "overwrite",
+                                              output_formats: Tuple[str, ...] = ("csv",),
+                                              manifest: Optional[JobManifest] = None,
+                                              resample_bar_sizes: Tuple[str, ...] = ()) -> List[Dict]:
+    assert max_concurrent_requests >= 1
+    assert all(output_format == "csv" or output_format in columnar_file_extensions
+               for output_format in output_formats)
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    pipeline_slots = get_pipeline_slots(max_concurrent_requests)
+    unresolved_list = await qualify_contracts_async(symbol_list=symbol_list, contract_type=contract_type,
+                                                    semaphore=semaphore)
+    symbol_list = [symbol_dict for symbol_dict in symbol_list if symbol_dict not in unresolved_list]
+    results = await asyncio.gather(*[download_symbol_to_csv_async(index=index, symbol_dict=symbol_dict,
+                                                                  contract_type=contract_type,
+                                                                  csv_folderpath=csv_folderpath,
+                                                                  print_start_date=print_start_date,
+                                                                  semaphore=semaphore,
+                                                                  pipeline_slots=pipeline_slots,
+                                                                  update_mode=update_mode,
+                                                                  output_formats=output_formats,
+                                                                  manifest=manifest,
+                                                                  resample_bar_sizes=resample_bar_sizes)
+                                     for index, symbol_dict in enumerate(symbol_list)])
+    failed_list = [symbol_dict for symbol_dict, success in zip(symbol_list, results) if not success]
+    failed_list += unresolved_list
+    for symbol_dict in failed_list:
+        logger.error("Failed to download " + symbol_dict["Symbol"] + " " + symbol_dict["endDateTime"])
+    if bar_cache is not None:
+        bar_cache.log_statistics()
+    if empty_result_history is not None:
+        empty_result_history.save()
+    return failed_list
+
+
+# download intraday data from Interactive Brokers
+# contract_type can be "forex", "cfd", "index" or "cont_futures"
+# update_mode : "overwrite" or "append". See download_symbol_to_csv_async()
+# output_formats : any of "csv", "parquet", "arrow". See write_bars()
+# manifest : job manifest to resume an interrupted job with, or None. See JobManifest
+# resample_bar_sizes : coarser bar sizes to derive from the downloaded bars, see resample_bars()
+# return entries of symbol_list that failed to download
+def download_intraday_data_to_csv(symbol_list: List[Dict], contract_type: str,
+                                  csv_folderpath: str, print_start_date="no",
+                                  max_concurrent_requests: int = 10,
+                                  update_mode: str = "overwrite",
+                                  output_formats: Tuple[str, ...] = ("csv",),
+                                  manifest: Optional[JobManifest] = None,
+                                  resample_bar_sizes: Tuple[str, ...] = ()) -> List[Dict]:
+    return ib.run(download_intraday_data_to_csv_async(symbol_list=symbol_list, contract_type=contract_type,
+                                                      csv_folderpath=csv_folderpath,
+                                                      print_start_date=print_start_date,
+                                                      max_concurrent_requests=max_concurrent_requests,
+                                                      update_mode=update_mode,
+                                                      output_formats=output_formats,
+                                                      manifest=manifest,
+                                                      resample_bar_sizes=resample_bar_sizes))
+
+
+# csv filepath of the single stitched history file of symbol_dict, e.g. EURUSD_1_hour_history.csv
+def get_stitched_csv_filepath(symbol_dict: Dict, csv_folderpath: str) -> str:
+    csv_filename = symbol_dict["Symbol"] + '_' + symbol_dict["barSizeSetting"] + "_history.csv"
+    return csv_folderpath + csv_filename.replace(" ", "_")
+
+
+# earliest date IB has data for, or None if IB can't tell
+async def request_head_timestamp_async(contract: Contract, symbol_dict: Dict,
+                                       semaphore: asyncio.Semaphore) -> Optional[datetime.datetime]:
+    async with semaphore:
+        try:
+            async with ib_connection() as connection:
+                head_timestamp = await connection.reqHeadTimeStampAsync(contract, whatToShow=symbol_dict["whatToShow"],
+                                                                        useRTH=False, formatDate=1)
+        except (RequestError, ConnectionError) as e:
+            logger.warning("No head timestamp for " + symbol_dict["Symbol"] + ": " + str(e))
+            return None
+    if not isinstance(head_timestamp, datetime.datetime):
+        return None
+    return get_bar_datetime(head_timestamp)  # compared with bar dates in TWS timezone
+
+
+# write one chunk of bar rows from get_bar_rows() in every format of output_formats. Runs in the
+# post-processing stage. In csv format the chunk is written to its own part file with header.
+# Only bars before end_datetime are written so that chunks don't overlap.
+# resampled_part_filepaths : part filepath of each coarser bar size to derive from the chunk, see write_bars()
+# trading_hours, time_zone_id : sessions of the contract to derive coarser bars in, see resample_bar_rows()
+# trim_first_day : leave out the earliest trading day of the chunk, see get_trading_day_seconds(), unless it is
+#                  the only one. The window of a chunk may start within that day, and the next chunk, which
+#                  ends at the first bar after it, gets it whole. So chunks are cut at trading day boundaries
+#                  and no coarser bar straddles two chunks
+# return date of earliest bar written, or None if the chunk has no bars before end_datetime,
+# and metrics with transform_seconds, write_seconds and bytes_written
+def write_history_chunk(rows: List[Tuple], symbol_dict: Dict, part_filepath: str,
+                        end_datetime: Optional[datetime.datetime], output_formats: Tuple[str, ...],
+                        resampled_part_filepaths: Optional[Dict[str, str]] = None,
+                        trading_hours: Optional[str] = None, time_zone_id: Optional[str] = None,
+                        trim_first_day: bool = False) -> Tuple[Optional[datetime.datetime], Dict]:
+    import numpy as np
+
+    start = time.perf_counter()
+    dated_rows = [(get_bar_datetime(row[0]), row) for row in rows]
+    if end_datetime is not None:
+        dated_rows = [dated_row for dated_row in dated_rows if dated_row[0] < end_datetime]
+    if not dated_rows:
+        return None, {}
+    # sorted by date, last of duplicate dates kept
+    dated_rows.sort(key=lambda dated_row: dated_row[0])
+    rows = [row for number, (date, row) in enumerate(dated_rows)
+            if number + 1 == len(dated_rows) or dated_rows[number + 1][0] != date]
+    if trim_first_day:
+        seconds = get_bar_dates(get_bar_frame(rows)).astype(np.int64)
+        sessions = get_row_session_calendar(rows=rows, seconds=seconds, trading_hours=trading_hours,
+                                            time_zone_id=time_zone_id)
+        opens, closes = get_bar_sessions(seconds, source_seconds=bar_size_to_seconds(symbol_dict["barSizeSetting"]),
+                                         sessions=sessions)
+        days = get_trading_day_seconds(seconds, opens=opens, closes=closes)
+        rows = rows[int(np.argmax(days != days[0])):]
+    transform_seconds = time.perf_counter() - start
+    metrics = write_bars(rows=rows, symbol_dict=symbol_dict, csv_filepath=part_filepath,
+                         output_formats=output_formats, resampled_filepaths=resampled_part_filepaths,
+                         trading_hours=trading_hours, time_zone_id=time_zone_id)
+    add_metric(metrics, "transform_seconds", transform_seconds)
+    return get_bar_datetime(rows[0][0]), metrics
+
+
+# concatenate chunk part files, newest chunk first in part_filepaths, into one csv file sorted by date.
+# Streams file contents, so memory use doesn't depend on length of history
+def concatenate_history_chunks(part_filepaths: List[str], csv_filepath: str) -> None:
+    import os
+    import shutil
+
+    tmp_filepath = csv_filepath + ".tmp"
+    with open(tmp_filepath, "wb") as output_file:
+        for number, part_filepath in enumerate(reversed(part_filepaths)):
+            with open(part_filepath, "rb") as part_file:
+                header = part_file.readline()
+                if number == 0:
+                    output_file.write(header)
+                shutil.copyfileobj(part_file, output_file)
+    os.replace(tmp_filepath, csv_filepath)
+    return None
+
+
+# download whole intraday history of one symbol into a single csv file sorted by date without duplicates.
+# The first chunk is the latest durationStr window. Each later chunk ends at the earliest bar returned
+# by the chunk before it, until IB's head timestamp is reached or IB returns no earlier bars.
+# Each chunk is written to a part file as it arrives and the part files are concatenated at the end,
+# so at most one chunk per symbol is held in memory.
+# pipeline_slots bounds chunks waiting for post-processing, see get_pipeline_slots()
+# output_formats : any of "csv", "parquet", "arrow". Columnar formats are merged chunk by chunk
+# manifest : job manifest to resume an interrupted job with, or None. Part files of an unfinished
+#            symbol are then kept, so that the next run continues from its last written chunk
+# resample_bar_sizes : coarser bar sizes to derive chunk by chunk into their own history files. Every chunk
+#                      but the last leaves out its earliest trading day for the next chunk, so that coarser
+#                      bars never straddle two chunks, see write_history_chunk()
+async def download_stitched_history_async(index: int, symbol_dict: Dict, contract_type: str,
+                                          csv_folderpath: str, semaphore: asyncio.Semaphore,
+                                          pipeline_slots: asyncio.Semaphore, max_chunks: int = 20,
+                                          output_formats: Tuple[str, ...] = ("csv",),
+                                          manifest: Optional[JobManifest] = None,
+                                          resample_bar_sizes: Tuple[str, ...] = ()) -> bool:
+    import os
+    import traceback
+
+    csv_filepath = get_stitched_csv_filepath(symbol_dict=symbol_dict, csv_folderpath=csv_folderpath)
+    resampled_filepaths = {bar_size: get_stitched_csv_filepath(symbol_dict=dict(symbol_dict, barSizeSetting=bar_size),
+                                                               csv_folderpath=csv_folderpath)
+                           for bar_size in resample_bar_sizes}
+    if manifest is not None and await is_chunk_done_async(manifest=manifest, key=csv_filepath,
+                                                          filepath=csv_filepath):
+        logger.info("Skipping " + str(index) + " " + os.path.basename(csv_filepath) + ", done in previous run")
+        return True
+    contract = get_contract(symbol_dict=symbol_dict, contract_type=contract_type)
+    head_timestamp = await request_head_timestamp_async(contract=contract, symbol_dict=symbol_dict,
+                                                        semaphore=semaphore)
+
+    part_filepaths: List[str] = []
+    resampled_part_filepaths: Dict[str, List[str]] = {bar_size: [] for bar_size in resample_bar_sizes}
+    number_of_chunks = 0
+    end_datetime: Optional[datetime.datetime] = None
+    success = False
+    try:
+        for chunk in range(max_chunks):
+            end_date_time = "" if end_datetime is None else end_datetime.strftime("%Y%m%d %H:%M:%S")
+            part_filepath = csv_filepath + ".part" + str(chunk)
+            # part files of coarser bar sizes of this chunk
+            chunk_parts = {bar_size: filepath + ".part" + str(chunk)
+                           for bar_size, filepath in resampled_filepaths.items()}
+            chunk_dict = dict(symbol_dict, endDateTime=end_date_time)
+            if manifest is not None and await is_chunk_done_async(manifest=manifest, key=part_filepath,
+                                                                  filepath=part_filepath):
+                # chunk was written before the job was interrupted
+                earliest_bar = manifest.get(part_filepath)["earliest_bar"]
+                earliest_datetime = None if earliest_bar is None else datetime.datetime.fromisoformat(earliest_bar)
+            else:
+                earliest_datetime = await download_history_chunk_async(index=index, chunk=chunk,
+                                                                        contract=contract, chunk_dict=chunk_dict,
+                                                                        contract_type=contract_type,
+                                                                        csv_filepath=csv_filepath,
+                                                                        part_filepath=part_filepath,
+                                                                        end_datetime=end_datetime,
+                                                                        semaphore=semaphore,
+                                                                        pipeline_slots=pipeline_slots,
+                                                                        output_formats=output_formats,
+                                                                        manifest=manifest,
+                                                                        resampled_part_filepaths=chunk_parts,
+                                                                        trim_first_day=bool(chunk_parts)
+                                                                        and chunk + 1 < max_chunks)
+            if earliest_datetime is None:
+                break  # no bars earlier than previous chunk
+            number_of_chunks += 1
+            if "csv" in output_formats:
+                part_filepaths.append(part_filepath)
+                for bar_size, resampled_part_filepath in chunk_parts.items():
+                    resampled_part_filepaths[bar_size].append(resampled_part_filepath)
+            end_datetime = earliest_datetime
+            if head_timestamp is not None and end_datetime <= head_timestamp:
+                break
+
+        if number_of_chunks == 0:
+            logger.warning("No data downloaded for " + os.path.basename(csv_filepath))
+        elif part_filepaths:
+            await post_process_async(concatenate_history_chunks, part_filepaths, csv_filepath)
+            for bar_size, resampled_filepath in resampled_filepaths.items():
+                await post_process_async(concatenate_history_chunks, resampled_part_filepaths[bar_size],
+                                         resampled_filepath)
+        if manifest is not None:
+            manifest.start(key=csv_filepath, symbol_dict=symbol_dict)
+            checksum = None
+            if part_filepaths:
+                checksum = await post_process_async(get_file_checksum, csv_filepath)
+            manifest.finish(key=csv_filepath, state="done" if number_of_chunks else "no_data", checksum=checksum)
+        success = True
+    except Exception:
+        logger.info(traceback.format_exc())
+        return False
+    finally:
+        if success or manifest is None:
+            for part_filepath in part_filepaths + sum(resampled_part_filepaths.values(), []):
+                if os.path.exists(part_filepath):
+                    os.remove(part_filepath)
+    return True
+
+
+# download one chunk of download_stitched_history_async() and write it to part_filepath, and its coarser
+# bars to resampled_part_filepaths. Only bars before end_datetime are written.
+# trim_first_day : leave out the earliest trading day, see write_history_chunk()
+# return date of earliest bar written, or None if IB has no bars before end_datetime
+async def download_history_chunk_async(index: int, chunk: int, contract: Contract, chunk_dict: Dict,
+                                       contract_type: str, csv_filepath: str, part_filepath: str,
+                                       end_datetime: Optional[datetime.datetime], semaphore: asyncio.Semaphore,
+                                       pipeline_slots: asyncio.Semaphore, output_formats: Tuple[str, ...],
+                                       manifest: Optional[JobManifest], resampled_part_filepaths: Dict[str, str],
+                                       trim_first_day: bool = False) -> Optional[datetime.datetime]:
+    import os
+
+    metrics = new_request_metrics(symbol_dict=chunk_dict, contract=contract)
+    queued = time.monotonic()
+    async with pipeline_slots:
+        add_metric(metrics, "queue_wait", time.monotonic() - queued)
+        logger.info("Downloading " + str(index) + " " + os.path.basename(csv_filepath)
+                    + " chunk " + str(chunk) + " ending " + (chunk_dict["endDateTime"] or "now"))
+        if manifest is not None:
+            manifest.start(key=part_filepath, symbol_dict=chunk_dict)
+        try:
+            bars = await request_historical_bars_async(contract=contract, symbol_dict=chunk_dict,
+                                                       semaphore=semaphore, metrics=metrics)
+            metrics["bars"] = len(bars)
+            earliest_datetime = None
+            rows = get_bar_rows(bars)
+            if rows and quality_report_folderpath is not None:
+                rows = await quality_gate_async(rows=rows, contract=contract, symbol_dict=chunk_dict,
+                                                contract_type=contract_type, semaphore=semaphore,
+                                                report_name=os.path.basename(part_filepath).replace(".csv", ""))
+            if rows:
+                trading_hours, time_zone_id = get_cached_trading_hours(symbol_dict=chunk_dict,
+                                                                       contract_type=contract_type)
+                earliest_datetime, chunk_metrics = await post_process_write_async(
+                    chunk_dict, csv_filepath, output_formats, write_history_chunk, rows, chunk_dict, part_filepath,
+                    end_datetime, output_formats, resampled_part_filepaths, trading_hours, time_zone_id,
+                    trim_first_day)
+                metrics.update(chunk_metrics)
+            if earliest_datetime is None:
+                metrics["status"] = "empty"
+            checksum = None
+            if manifest is not None and earliest_datetime is not None and "csv" in output_formats:
+                checksum = await post_process_async(get_file_checksum, part_filepath)
+        except Exception:
+            metrics["status"] = "failed"
+            if manifest is not None:
+                manifest.finish(key=part_filepath, state="failed")
+            raise
+        finally:
+            record_request_metrics(metrics)
+    if manifest is not None:
+        manifest.finish(key=part_filepath, state="no_data" if earliest_datetime is None else "done",
+                        checksum=checksum, earliest_bar=earliest_datetime)
+    return earliest_datetime
+
+
+# download whole intraday history of every entry in symbol_list into one csv file per symbol.
+# Symbols are downloaded concurrently, chunks of one symbol one after another.
+# output_formats : any of "csv", "parquet", "arrow"
+# manifest : job manifest to resume an interrupted job with, or None. See JobManifest
+# resample_bar_sizes : coarser bar sizes to derive from the downloaded bars, see resample_bars()
+# return entries of symbol_list that failed to download
+def download_stitched_history_to_csv(symbol_list: List[Dict], contract_type: str, csv_folderpath: str,
+                                     max_concurrent_requests: int = 10,
+                                     output_formats: Tuple[str, ...] = ("csv",),
+                                     manifest: Optional[JobManifest] = None,
+                                     resample_bar_sizes: Tuple[str, ...] = ()) -> List[Dict]:
+    async def download_all_async() -> List[Dict]:
+        semaphore = asyncio.Semaphore(max_concurrent_requests)
+        pipeline_slots = get_pipeline_slots(max_concurrent_requests)
+        unresolved_list = await qualify_contracts_async(symbol_list=symbol_list, contract_type=contract_type,
+                                                        semaphore=semaphore)
+        resolved_list = [symbol_dict for symbol_dict in symbol_list if symbol_dict not in unresolved_list]
+        results = await asyncio.gather(*[download_stitched_history_async(index=index, symbol_dict=symbol_dict,
+                                                                         contract_type=contract_type,
+                                                                         csv_folderpath=csv_folderpath,
+                                                                         semaphore=semaphore,
+                                                                         pipeline_slots=pipeline_slots,
+                                                                         output_formats=output_formats,
+                                                                         manifest=manifest,
+                                                                         resample_bar_sizes=resample_bar_sizes)
+                                         for index, symbol_dict in enumerate(resolved_list)])
+        return [symbol_dict for symbol_dict, success in zip(resolved_list, results) if not success] \
+            + unresolved_list
+
+    assert max_concurrent_requests >= 1
+    failed_list = ib.run(download_all_async())
+    for symbol_dict in failed_list:
+        logger.error("Failed to download history of " + symbol_dict["Symbol"])
+    if bar_cache is not None:
+        bar_cache.log_statistics()
+    return failed_list
+
+
+# whatToShow of the recent data of contract_type
+# can't show 'TRADES' for FOREX AND CFD. See https://interactivebrokers.github.io/tws-api/historical_bars.html
+def get_recent_what_to_show(contract_type: str) -> str:
     if contract_type == "forex" or contract_type == 'cfd':
         what_to_show = "MIDPOINT"
     elif contract_type == "index":
@@ -228,39 +2247,179 @@ def download_recent_intraday_data(folderpath, number_of_days: int, download_list
         what_to_show = "TRADES"
     else:
         assert False
+    return what_to_show
+
 
+# symbol list of the latest number_of_days of every entry of download_list, see load_universe().
+# durationStr overrides number_of_days of its entry
+def get_recent_symbol_list(download_list: List, contract_type: str, number_of_days: int,
+                           bar_size: str) -> List[Dict]:
+    assert type(number_of_days) == int and (0 <= number_of_days <= 360)
+    what_to_show = get_recent_what_to_show(contract_type)
     duration = str(number_of_days) + " D"
 
-    if contract_type == "forex":
-        for index in range(0, len(download_list)):
-            symbol_list = get_symbol_list(symbol=download_list[index], bar_size=bar_size,
-                                          what_to_show=what_to_show,
-                                          duration=duration,
-                                          fullname=download_list[index]
-                                          )
-
-            download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
-                                          csv_folderpath=folderpath)
-    elif contract_type == "cfd" or contract_type == "index" or contract_type == "cont_futures":
-        for index in range(0, len(download_list)):
-            symbol_list = get_symbol_list(symbol=download_list[index]["Symbol"], bar_size=bar_size,
-                                          what_to_show=what_to_show,
-                                          duration=duration,
-                                          fullname=download_list[index]["FullName"],
-                                          exchange=download_list[index]["Exchange"],
-                                          currency=download_list[index]["Currency"]
-                                          )
-
-            download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
-                                          csv_folderpath=folderpath)
-    else:
-        assert False
+    symbol_list: List[Dict] = []
+    for entry in download_list:
+        entry = get_universe_entry(entry, contract_type=contract_type)
+        symbol_list += get_symbol_list(symbol=entry["Symbol"], bar_size=bar_size,
+                                       what_to_show=entry.get("whatToShow", what_to_show),
+                                       duration=entry.get("durationStr", duration),
+                                       fullname=entry["FullName"],
+                                       exchange=entry["Exchange"],
+                                       currency=entry["Currency"]
+                                       )
+    return symbol_list
+
+
+# download recent forex data in hourly bars
+# contract_type : "forex", "cfd", "index"
+# max_concurrent_requests : number of historical data requests kept in flight at the same time
+# update_mode : "overwrite" to download all number_of_days again,
+#               "append" to only download and append bars since the last bar of existing csv files
+# download_list : entries of load_universe(). durationStr overrides number_of_days of its entry
+# output_formats : any of "csv" for Amibroker, "parquet", "arrow" for columnar files partitioned by symbol and year
+# bar_size : bar size to download from IB
+# resample_bar_sizes : coarser bar sizes, e.g. ("4 hours", "1 day"), derived locally from the downloaded bars
+#                      and written to their own files instead of requesting them from IB. Needs update_mode
+#                      "overwrite"
+def download_recent_intraday_data(folderpath, number_of_days: int, download_list, contract_type,
+                                  max_concurrent_requests: int = 10, update_mode: str = "overwrite",
+                                  output_formats: Tuple[str, ...] = ("csv",), bar_size: str = "1 hour",
+                                  resample_bar_sizes: Tuple[str, ...] = ()) -> None:
+    # collect every symbol first so that all requests can be in flight concurrently
+    symbol_list = get_recent_symbol_list(download_list=download_list, contract_type=contract_type,
+                                         number_of_days=number_of_days, bar_size=bar_size)
+
+    download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
+                                  csv_folderpath=folderpath,
+                                  max_concurrent_requests=max_concurrent_requests,
+                                  update_mode=update_mode,
+                                  output_formats=output_formats,
+                                  resample_bar_sizes=resample_bar_sizes)
 
     return None
 
 
-def download_historical_intraday_data(folderpath: str, download_list: List[str], contract_type: str) -> None:
-    bar_size = "1 hour"
+# order of an entry of the download queue of download_recent_universe_data(): contracts demoted by
+# empty_result_history last, then higher priority first, then earlier deadline first
+def get_download_queue_order(work: Dict) -> Tuple:
+    demoted = False
+    if empty_result_history is not None:
+        demoted = empty_result_history.is_demoted(ContractCache.get_key(symbol_dict=work["symbol_dict"],
+                                                                        contract_type=work["contract_type"]))
+    deadline = work["deadline"] if work["deadline"] is not None else float("inf")
+    return demoted, -work["priority"], deadline
+
+
+# download every entry of work_list, dicts of symbol_dict, contract_type, priority and deadline, from one
+# priority queue, see get_download_queue_order(). Workers take the next entry as soon as they are done with
+# one, so high priority contracts are written first and the rest fill in after.
+# return symbol_dict of entries that failed to download
+async def download_work_list_async(work_list: List[Dict], csv_folderpath: str, max_concurrent_requests: int = 10,
+                                   update_mode: str = "overwrite", output_formats: Tuple[str, ...] = ("csv",),
+                                   resample_bar_sizes: Tuple[str, ...] = ()) -> List[Dict]:
+    assert max_concurrent_requests >= 1
+    start = time.monotonic()
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    pipeline_slots = get_pipeline_slots(max_concurrent_requests)
+
+    contract_types = sorted({work["contract_type"] for work in work_list})
+    unresolved_lists = await asyncio.gather(*[qualify_contracts_async(
+        symbol_list=[work["symbol_dict"] for work in work_list if work["contract_type"] == contract_type],
+        contract_type=contract_type, semaphore=semaphore) for contract_type in contract_types])
+    failed_list: List[Dict] = sum(unresolved_lists, [])
+
+    queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    for number, work in enumerate(work_list):
+        if work["symbol_dict"] not in failed_list:
+            queue.put_nowait((get_download_queue_order(work), number, work))
+    missed_deadlines = 0
+
+    async def worker() -> None:
+        nonlocal missed_deadlines
+
+        while not queue.empty():
+            order, number, work = queue.get_nowait()
+            success = await download_symbol_to_csv_async(index=number, symbol_dict=work["symbol_dict"],
+                                                         contract_type=work["contract_type"],
+                                                         csv_folderpath=csv_folderpath, print_start_date="no",
+                                                         semaphore=semaphore, pipeline_slots=pipeline_slots,
+                                                         update_mode=update_mode, output_formats=output_formats,
+                                                         resample_bar_sizes=resample_bar_sizes)
+            if not success:
+                failed_list.append(work["symbol_dict"])
+            seconds = time.monotonic() - start
+            if work["deadline"] is not None and seconds > work["deadline"]:
+                missed_deadlines += 1
+                logger.warning(work["symbol_dict"]["Symbol"] + " missed its deadline of " + str(work["deadline"])
+                               + " seconds by " + str(round(seconds - work["deadline"], 1)) + " seconds")
+
+    # one worker per pipeline slot, so that the queue, not the slots, decides what is downloaded next
+    await asyncio.gather(*[worker() for _ in range(max_concurrent_requests + post_processing_max_pending_writes)])
+    for symbol_dict in failed_list:
+        logger.error("Failed to download " + symbol_dict["Symbol"] + " " + symbol_dict["endDateTime"])
+    if missed_deadlines:
+        logger.warning(str(missed_deadlines) + " contracts missed their deadline")
+    if bar_cache is not None:
+        bar_cache.log_statistics()
+    if empty_result_history is not None:
+        empty_result_history.save()
+    return failed_list
+
+
+# work list of download_work_list_async() with the latest number_of_days of every entry of universe of
+# contract_types, all of them if None
+def get_universe_work_list(universe: Dict[str, List[Dict]], contract_types: Optional[Tuple[str, ...]],
+                           number_of_days: int, bar_size: str) -> List[Dict]:
+    work_list: List[Dict] = []
+    for contract_type in contract_types or tuple(universe):
+        for entry in universe[contract_type]:
+            for symbol_dict in get_recent_symbol_list(download_list=[entry], contract_type=contract_type,
+                                                      number_of_days=number_of_days, bar_size=bar_size):
+                work_list.append({"symbol_dict": symbol_dict, "contract_type": contract_type,
+                                  "priority": entry.get("priority", 0), "deadline": entry.get("deadline")})
+    return work_list
+
+
+# download recent intraday data of every contract type in contract_types of universe, see load_universe(),
+# in one queue ordered by the priority and deadline of each entry instead of one contract type after another.
+# contract_types : contract types of universe to download, all of them if None
+# priority : entries with higher priority are downloaded first, 0 by default
+# deadline : seconds from start of the download by which the entry should be written. Entries of the same
+#            priority are downloaded in order of their deadline, and missed deadlines are logged
+# Contracts that returned no bars max_empty_streak times in a row go last, see EmptyResultHistory.
+# See download_recent_intraday_data() for the other parameters
+# return symbol_dict of entries that failed to download
+def download_recent_universe_data(folderpath: str, number_of_days: int, universe: Dict[str, List[Dict]],
+                                  contract_types: Optional[Tuple[str, ...]] = None,
+                                  max_concurrent_requests: int = 10, update_mode: str = "overwrite",
+                                  output_formats: Tuple[str, ...] = ("csv",), bar_size: str = "1 hour",
+                                  resample_bar_sizes: Tuple[str, ...] = ()) -> List[Dict]:
+    work_list = get_universe_work_list(universe=universe, contract_types=contract_types,
+                                       number_of_days=number_of_days, bar_size=bar_size)
+    return ib.run(download_work_list_async(work_list=work_list, csv_folderpath=folderpath,
+                                           max_concurrent_requests=max_concurrent_requests,
+                                           update_mode=update_mode, output_formats=output_formats,
+                                           resample_bar_sizes=resample_bar_sizes))
+
+
+# download_list : entries of load_universe()
+# max_concurrent_requests : number of historical data requests kept in flight at the same time
+# backfill_mode : "chunks" to write every 360 D chunk from get_symbol_history_list() to its own csv file,
+#                 "stitched" to write whole history of each symbol into one csv file sorted by date
+# output_formats : any of "csv" for Amibroker, "parquet", "arrow" for columnar files partitioned by symbol and year
+# manifest_filepath : SQLite job manifest recording finished chunks, or None. When the download is interrupted,
+#                     running it again with the same manifest_filepath only downloads unfinished chunks.
+#                     The manifest is deleted once every chunk has been downloaded
+# bar_size : bar size to download from IB
+# resample_bar_sizes : coarser bar sizes, e.g. ("4 hours", "1 day"), derived locally from the downloaded bars
+#                      and written to their own files instead of requesting them from IB
+def download_historical_intraday_data(folderpath: str, download_list: List, contract_type: str,
+                                      max_concurrent_requests: int = 10, backfill_mode: str = "chunks",
+                                      output_formats: Tuple[str, ...] = ("csv",),
+                                      manifest_filepath: Optional[str] = None, bar_size: str = "1 hour",
+                                      resample_bar_sizes: Tuple[str, ...] = ()) -> None:
+    assert backfill_mode in ("chunks", "stitched")
     # can't show 'TRADES' for CFD. See https://interactivebrokers.github.io/tws-api/historical_bars.html
     # can't show 'TRADES' for FOREX AND CFD. See https://interactivebrokers.github.io/tws-api/historical_bars.html
     if contract_type == "forex":
@@ -276,27 +2435,220 @@ def download_historical_intraday_data(folderpath: str, download_list: List[str],
         assert False
     duration = "360 D"
 
-    if contract_type == "forex":
-        for index in range(0, len(download_list)):
-            symbol_list = get_symbol_history_list(symbol=download_list[index], bar_size=bar_size,
-                                                  what_to_show=what_to_show,
-                                                  duration=duration,
-                                                  fullname=download_list[index]
-                                                  )
-            download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
-                                          csv_folderpath=folderpath)
-    elif contract_type == "cfd" or contract_type == "index" or contract_type == "cont_futures":
-        for index in range(0, len(download_list)):
-            symbol_list = get_symbol_history_list(symbol=download_list[index]["Symbol"], bar_size=bar_size,
-                                                  what_to_show=what_to_show,
-                                                  duration=duration,
-                                                  fullname=download_list[index]["FullName"],
-                                                  exchange=download_list[index]["Exchange"],
-                                                  currency=download_list[index]["Currency"]
-                                                  )
-            download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
-                                          csv_folderpath=folderpath)
+    # stitched mode needs only one entry per symbol. Chunk boundaries are worked out while downloading
+    if backfill_mode == "stitched":
+        get_download_list = get_symbol_list
+    else:
+        get_download_list = get_symbol_history_list
+
+    # collect every chunk of every symbol first so that all requests can be in flight concurrently.
+    # durationStr overrides of the universe don't apply, history is always downloaded in chunks of duration
+    symbol_list: List[Dict] = []
+    for entry in download_list:
+        entry = get_universe_entry(entry, contract_type=contract_type)
+        symbol_list += get_download_list(symbol=entry["Symbol"], bar_size=bar_size,
+                                         what_to_show=entry.get("whatToShow", what_to_show),
+                                         duration=duration,
+                                         fullname=entry["FullName"],
+                                         exchange=entry["Exchange"],
+                                         currency=entry["Currency"]
+                                         )
+
+    manifest = None
+    if manifest_filepath is not None:
+        manifest = JobManifest(filepath=manifest_filepath)
+
+    if backfill_mode == "stitched":
+        failed_list = download_stitched_history_to_csv(symbol_list=symbol_list, contract_type=contract_type,
+                                                       csv_folderpath=folderpath,
+                                                       max_concurrent_requests=max_concurrent_requests,
+                                                       output_formats=output_formats,
+                                                       manifest=manifest,
+                                                       resample_bar_sizes=resample_bar_sizes)
+    else:
+        failed_list = download_intraday_data_to_csv(symbol_list=symbol_list, contract_type=contract_type,
+                                                    csv_folderpath=folderpath,
+                                                    max_concurrent_requests=max_concurrent_requests,
+                                                    output_formats=output_formats,
+                                                    manifest=manifest,
+                                                    resample_bar_sizes=resample_bar_sizes)
+
+    if manifest is not None:
+        if failed_list:
+            logger.warning(str(manifest.get_unfinished_count()) + " chunks unfinished. Run again to resume from "
+                           + manifest_filepath)
+            manifest.close()
+        else:
+            manifest.remove()
+    return None
+
+
+# True if a session of trading_hours in time_zone_id, see parse_trading_hours(), is open at now, a timezone
+# aware datetime, or closed less than grace_seconds before now, so that the last bar of a session is refreshed
+def is_session_open(trading_hours: str, time_zone_id: str, now: datetime.datetime, grace_seconds: float) -> bool:
+    import pandas as pd
+
+    exchange_now = pd.Timestamp(now).tz_convert(time_zone_id).tz_localize(None).to_pydatetime()
+    grace = datetime.timedelta(seconds=grace_seconds)
+    return any(start <= exchange_now < end + grace for start, end in parse_trading_hours(trading_hours))
+
+
+# entries of work_list, see get_universe_work_list(), whose session is open according to the trading hours
+# in the contract cache. Contracts are qualified first, so that the cache has their trading hours.
+# Contracts IB can't resolve are left out. Without a contract cache every entry is returned
+async def get_open_work_list_async(work_list: List[Dict], bar_size: str,
+                                   semaphore: asyncio.Semaphore) -> List[Dict]:
+    if contract_cache is None:
+        return work_list
+    contract_types = sorted({work["contract_type"] for work in work_list})
+    unresolved_lists = await asyncio.gather(*[qualify_contracts_async(
+        symbol_list=[work["symbol_dict"] for work in work_list if work["contract_type"] == contract_type],
+        contract_type=contract_type, semaphore=semaphore) for contract_type in contract_types])
+    unresolved_list = sum(unresolved_lists, [])
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    open_work_list = []
+    for work in work_list:
+        if work["symbol_dict"] in unresolved_list:
+            continue
+        entry = contract_cache.get(ContractCache.get_key(symbol_dict=work["symbol_dict"],
+                                                         contract_type=work["contract_type"]))
+        if entry is None or not entry["tradingHours"] or not entry["timeZoneId"] \
+                or is_session_open(trading_hours=entry["tradingHours"], time_zone_id=entry["timeZoneId"],
+                                   now=now, grace_seconds=bar_size_to_seconds(bar_size)):
+            open_work_list.append(work)
+    return open_work_list
+
+
+# seconds until the next bar of bar_size closes, in the wall clock time of this machine like TWS dates bars
+def get_seconds_to_next_bar(bar_size: str) -> float:
+    import calendar
+
+    now = time.time()
+    bar_seconds = bar_size_to_seconds(bar_size)
+    local_seconds = calendar.timegm(time.localtime(now)) + now % 1
+    return bar_seconds - local_seconds % bar_seconds
+
+
+# serve daemon_status as JSON to HTTP GET requests of any path on host:port, e.g. http://127.0.0.1:8765/
+async def serve_daemon_status_async(host: str, port: int):
+    import json
+
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # request line and headers end with an empty line. Their content doesn't matter
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            body = json.dumps(dict(daemon_status, connected=ib.isConnected()), indent=1).encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                         + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_request, host, port)
+    logger.info("Serving status on http://" + host + ":" + str(port) + "/")
+    return server
+
+
+# keep refreshing recent intraday data of universe, see download_recent_universe_data(), over one IB
+# connection. The first refresh starts right away, later ones settle_seconds after every bar close.
+# Only contracts whose session is open, or closed within the last bar, are refreshed, see
+# get_open_work_list_async(). The connection is restored from host, port, client_id and readonly when it drops.
+# A refresh that fails is logged, counted in daemon_status and tried again reconnect_seconds later
+# status_port : local port of the status endpoint, see serve_daemon_status_async(), or None for no endpoint
+# max_refreshes : number of refreshes before returning, or None to run until interrupted
+async def run_daemon_async(folderpath: str, universe: Dict[str, List[Dict]], number_of_days: int,
+                           host: str, port: int, client_id: int = 1, readonly: bool = True,
+                           contract_types: Optional[Tuple[str, ...]] = None, bar_size: str = "1 hour",
+                           update_mode: str = "append", output_formats: Tuple[str, ...] = ("csv",),
+                           max_concurrent_requests: int = 10, status_port: Optional[int] = 8765,
+                           settle_seconds: float = 5.0, reconnect_seconds: float = 60.0,
+                           max_refreshes: Optional[int] = None) -> None:
+    import traceback
+
+    work_list = get_universe_work_list(universe=universe, contract_types=contract_types,
+                                       number_of_days=number_of_days, bar_size=bar_size)
+    daemon_status.clear()
+    daemon_status.update(started=datetime.datetime.now().isoformat(timespec="seconds"), bar_size=bar_size,
+                         contracts=len(work_list), refreshes=0, last_refresh=None, last_refresh_seconds=None,
+                         open_contracts=None, failed=[], next_refresh=None, errors=0, last_error=None)
+    server = None
+    if status_port is not None:
+        server = await serve_daemon_status_async(host="127.0.0.1", port=status_port)
+    try:
+        while max_refreshes is None or daemon_status["refreshes"] < max_refreshes:
+            if not ib.isConnected():
+                try:
+                    await connect_ib_async(connection=ib, host=host, port=port, client_id=client_id,
+                                           readonly=readonly)
+                    logger.info("Connected to " + host + ":" + str(port))
+                except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                    logger.warning("Failed to reconnect to " + host + ":" + str(port) + ": " + str(e)
+                                   + ". Retrying in " + str(reconnect_seconds) + " seconds")
+                    await asyncio.sleep(reconnect_seconds)
+                    continue
+
+            start = time.monotonic()
+            daemon_status["last_refresh"] = datetime.datetime.now().isoformat(timespec="seconds")
+            try:
+                open_work_list = await get_open_work_list_async(work_list=work_list, bar_size=bar_size,
+                                                                semaphore=asyncio.Semaphore(max_concurrent_requests))
+                logger.info("Refreshing " + str(len(open_work_list)) + " of " + str(len(work_list))
+                            + " contracts with open sessions")
+                failed_list = await download_work_list_async(work_list=open_work_list, csv_folderpath=folderpath,
+                                                             max_concurrent_requests=max_concurrent_requests,
+                                                             update_mode=update_mode, output_formats=output_formats)
+            except asyncio.CancelledError:
+                raise  # an Exception before Python 3.8
+            except Exception as e:
+                # e.g. the connection dropped while contracts were qualified. Reconnect and refresh again
+                logger.error("Refresh failed: " + repr(e) + ". Retrying in " + str(reconnect_seconds) + " seconds")
+                logger.info(traceback.format_exc())
+                if isinstance(e, ConnectionError) and ib.isConnected():
+                    ib.disconnect()
+                daemon_status.update(errors=daemon_status["errors"] + 1, last_error=repr(e),
+                                     next_refresh=(datetime.datetime.now()
+                                                   + datetime.timedelta(seconds=reconnect_seconds)
+                                                   ).isoformat(timespec="seconds"))
+                await asyncio.sleep(reconnect_seconds)
+                continue
+            finally:
+                if run_metrics is not None:
+                    run_metrics.log_summary()
+                    run_metrics.clear()
+
+            wait = get_seconds_to_next_bar(bar_size) + settle_seconds
+            daemon_status.update(refreshes=daemon_status["refreshes"] + 1,
+                                 last_refresh_seconds=round(time.monotonic() - start, 3),
+                                 open_contracts=len(open_work_list),
+                                 failed=[symbol_dict["Symbol"] for symbol_dict in failed_list],
+                                 next_refresh=(datetime.datetime.now() + datetime.timedelta(seconds=wait)
+                                               ).isoformat(timespec="seconds"))
+            if max_refreshes is None or daemon_status["refreshes"] < max_refreshes:
+                await asyncio.sleep(wait)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    return None
 
+
+def run_daemon(folderpath: str, universe: Dict[str, List[Dict]], number_of_days: int,
+               host: str, port: int, client_id: int = 1, readonly: bool = True,
+               contract_types: Optional[Tuple[str, ...]] = None, bar_size: str = "1 hour",
+               update_mode: str = "append", output_formats: Tuple[str, ...] = ("csv",),
+               max_concurrent_requests: int = 10, status_port: Optional[int] = 8765,
+               settle_seconds: float = 5.0, reconnect_seconds: float = 60.0,
+               max_refreshes: Optional[int] = None) -> None:
+    ib.run(run_daemon_async(folderpath=folderpath, universe=universe, number_of_days=number_of_days,
+                            host=host, port=port, client_id=client_id, readonly=readonly,
+                            contract_types=contract_types, bar_size=bar_size, update_mode=update_mode,
+                            output_formats=output_formats, max_concurrent_requests=max_concurrent_requests,
+                            status_port=status_port, settle_seconds=settle_seconds,
+                            reconnect_seconds=reconnect_seconds, max_refreshes=max_refreshes))
     return None
 
 
@@ -313,161 +2665,197 @@ def import_forex_ascii(database_path: str, filename: str) -> None:
     return None
 
 
+# file in the csv folder where import_file_list_in_folder() records which files were imported into which database
+amibroker_import_state_filename = "amibroker_import_state.json"
+
+
+# Broker.Application COM object of Amibroker. The importers only call its LoadDatabase, Import and RefreshAll
+# methods, so any object with these methods can stand in for it, e.g. a stub recording the calls on Linux
+def get_amibroker_application():
+    import win32com.client
+
+    return win32com.client.Dispatch("Broker.Application")
+
+
+# modification time, size and sha256 of file. The sha256 of previous_state is reused if the file wasn't
+# modified since, so that unchanged files aren't read again
+def get_file_state(filepath: str, previous_state: Optional[Dict] = None) -> Dict:
+    import os
+
+    stat = os.stat(filepath)
+    file_state = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    if previous_state is not None and previous_state["mtime_ns"] == stat.st_mtime_ns \
+            and previous_state["size"] == stat.st_size:
+        file_state["sha256"] = previous_state["sha256"]
+    else:
+        file_state["sha256"] = get_file_checksum(filepath)
+    return file_state
+
+
+# import csv files into an Amibroker database in a single session. The database is loaded once, every file
+# whose contents changed since it was last imported into database_path is imported, and charts are
+# refreshed once at the end. Downloads rewrite files every run, so contents are compared, not just mtime.
+# state_filepath : json file recording the files imported into each database
+# concatenate : True to import all changed files as one concatenated file with a single Import call
+# file_format : import definition, see C:\Program Files\AmiBroker\Formats\import.types
+# application : Broker.Application COM object, or a stand-in for it. See get_amibroker_application()
+# return filepaths imported
+def import_files_to_amibroker(database_path: str, filepaths: List[str], state_filepath: str,
+                              concatenate: bool = False, file_format: str = "ibintra.format",
+                              application=None) -> List[str]:
+    import json
+    import os
+    import shutil
+    import tempfile
+
+    state: Dict[str, Dict] = {}
+    if os.path.isfile(state_filepath):
+        with open(state_filepath) as f:
+            state = json.load(f)
+    imported_states = state.setdefault(database_path, {})
+
+    changed_filepaths: List[str] = []
+    changed_states: Dict[str, Dict] = {}
+    for filepath in filepaths:
+        key = os.path.abspath(filepath)
+        file_state = get_file_state(filepath, previous_state=imported_states.get(key))
+        if key in imported_states and imported_states[key]["sha256"] == file_state["sha256"]:
+            imported_states[key] = file_state  # same contents, remember new mtime
+        else:
+            changed_filepaths.append(filepath)
+            changed_states[key] = file_state
+
+    if changed_filepaths:
+        if application is None:
+            application = get_amibroker_application()
+        application.LoadDatabase(database_path)
+        if concatenate:
+            file_descriptor, tmp_filepath = tempfile.mkstemp(suffix=".csv")
+            try:
+                with os.fdopen(file_descriptor, "wb") as output_file:
+                    for number, filepath in enumerate(changed_filepaths):
+                        with open(filepath, "rb") as input_file:
+                            header = input_file.readline()
+                            if number == 0:
+                                output_file.write(header)
+                            shutil.copyfileobj(input_file, output_file)
+                print("Amibroker : importing " + str(len(changed_filepaths)) + " files as " + tmp_filepath)
+                application.Import(0, tmp_filepath, file_format)
+            finally:
+                os.remove(tmp_filepath)
+        else:
+            for filepath in changed_filepaths:
+                print("Amibroker : importing file " + filepath)
+                application.Import(0, filepath, file_format)
+        application.RefreshAll()
+        imported_states.update(changed_states)
+    print("Amibroker : imported " + str(len(changed_filepaths)) + " files, skipped "
+          + str(len(filepaths) - len(changed_filepaths)) + " unchanged files")
+
+    tmp_filepath = state_filepath + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_filepath, state_filepath)
+    return changed_filepaths
+
+
 # database_path = path of amibroker forex database Sample "C:/AmiB/Forex-EOD"
 # folder_path = folder path of files containing forex eod data
-def import_file_list_in_folder(database_path: str, folder_path: str) -> None:
+# concatenate : True to import all changed files with a single Import call, see import_files_to_amibroker()
+# application : Broker.Application COM object, or a stand-in for it. See get_amibroker_application()
+def import_file_list_in_folder(database_path: str, folder_path: str, concatenate: bool = False,
+                               application=None) -> None:
     import os
-    n = 1
-    for file in os.listdir(folder_path)[:n]:
-        # if file.endswith(".csv") and file.startswith("FOREX"):
-        if file.endswith(".csv"):
-            file_pathname = os.path.join(folder_path, file)
-            import_forex_ascii(database_path=database_path, filename=file_pathname)
-            print("Amibroker : importing file " + file_pathname)
+
+    filepaths = [os.path.join(folder_path, file) for file in sorted(os.listdir(folder_path))
+                 # if file.endswith(".csv") and file.startswith("FOREX")
+                 if file.endswith(".csv")]
+    import_files_to_amibroker(database_path=database_path, filepaths=filepaths,
+                              state_filepath=os.path.join(folder_path, amibroker_import_state_filename),
+                              concatenate=concatenate, application=application)
+    return None
+
+
+universe_contract_types: Tuple[str, ...] = ("forex", "cfd", "index", "cont_futures")
+universe_entry_keys: Tuple[str, ...] = ("Symbol", "FullName", "Exchange", "Currency", "durationStr", "whatToShow",
+                                        "priority", "deadline")
+what_to_show_values: Tuple[str, ...] = ("TRADES", "MIDPOINT", "BID", "ASK", "BID_ASK", "ADJUSTED_LAST",
+                                        "HISTORICAL_VOLATILITY", "OPTION_IMPLIED_VOLATILITY")
+
+
+# entry of a download list as a dict with Symbol, FullName, Exchange, Currency and any per-symbol overrides.
+# Forex pairs can be plain strings, e.g. "EURUSD", and trade on IDEALPRO in their quote currency
+def get_universe_entry(entry, contract_type: str) -> Dict:
+    if isinstance(entry, str):
+        entry = {"Symbol": entry}
+    entry = dict(entry)
+    if contract_type == "forex":
+        entry.setdefault("Exchange", "IDEALPRO")
+        entry.setdefault("Currency", entry["Symbol"][3:])
+    entry.setdefault("FullName", entry["Symbol"])
+    return entry
+
+
+# check entry of universe file, raise ValueError naming the entry if it can't be downloaded
+def validate_universe_entry(entry: Dict, contract_type: str, filepath: str) -> None:
+    import re
+
+    name = filepath + " " + contract_type + " " + str(entry.get("Symbol"))
+    unknown_keys = sorted(set(entry) - set(universe_entry_keys))
+    if unknown_keys:
+        raise ValueError(name + ": unknown keys " + ", ".join(unknown_keys))
+    if contract_type == "forex" and not re.fullmatch(r"[A-Z]{6}", str(entry["Symbol"])):
+        raise ValueError(name + ": forex Symbol must be a currency pair, e.g. EURUSD")
+    for key in ("Symbol", "FullName", "Exchange", "Currency"):
+        if not isinstance(entry.get(key), str) or entry[key] == "":
+            raise ValueError(name + ": " + key + " missing")
+    if "durationStr" in entry and not re.fullmatch(r"[1-9][0-9]* [SDWMY]", str(entry["durationStr"])):
+        raise ValueError(name + ": durationStr must be an IB duration, e.g. \"30 D\"")
+    if "whatToShow" in entry and entry["whatToShow"] not in what_to_show_values:
+        raise ValueError(name + ": whatToShow must be one of " + ", ".join(what_to_show_values))
+    if "priority" in entry and (not isinstance(entry["priority"], int) or isinstance(entry["priority"], bool)):
+        raise ValueError(name + ": priority must be an integer")
+    if "deadline" in entry and (not isinstance(entry["deadline"], (int, float)) or isinstance(entry["deadline"], bool)
+                                or entry["deadline"] <= 0):
+        raise ValueError(name + ": deadline must be a positive number of seconds")
     return None
 
 
-forex_symbol_list: List[str] = \
-    ['EURUSD', 'USDSGD', 'USDJPY', 'USDHKD', 'USDCNH', 'USDCAD', 'USDCHF', 'EURSGD', 'GBPUSD',
-     'EURGBP', 'EURAUD', 'GBPUSD', 'EURGBP', 'EURAUD', 'GBPUSD', 'GBPAUD', 'AUDUSD', 'AUDSGD',
-     'AUDHKD', 'AUDCNH', 'AUDJPY', 'NZDUSD', 'SGDJPY', 'SGDCNH', 'CHFJPY', 'EURCHF', 'USDKRW', 'CADJPY',
-     'EURCAD', 'AUDCAD', 'GBPNZD', 'GBPSGD', 'USDCZK', 'USDDKK', 'USDHUF', 'USDILS', 'USDKRW',
-     'USDMXN', 'USDNOK', 'USDPLN', 'USDRUB', 'USDSEK', 'USDTRY', 'USDZAR'
-     ]
-
-cfd_list: List[Dict] = [
-    {"Symbol": 'IBUS500', "FullName": "S&P500_CFD", "Exchange": "SMART", "Currency": "USD"},
-    {"Symbol": 'IBUST100', "FullName": "Nasdaq100_CFD", "Exchange": "SMART", "Currency": "USD"},
-    {"Symbol": 'IBUS30', "FullName": "DowJonesIndustrialAverage_CFD", "Exchange": "SMART", "Currency": "USD"},
-    {"Symbol": 'IBDE30', "FullName": "Dax30_CFD", "Exchange": "SMART", "Currency": "EUR"},
-    {"Symbol": 'IBFR40', "FullName": "CAC30_CFD", "Exchange": "SMART", "Currency": "EUR"},
-    {"Symbol": 'IBGB100', "FullName": "FTSE100_CFD", "Exchange": "SMART", "Currency": "GBP"},
-    {"Symbol": 'IBES35', "FullName": "IBEX35_CFD", "Exchange": "SMART", "Currency": "EUR"},
-    {"Symbol": 'IBCH20', "FullName": "SMI20_CFD", "Exchange": "SMART", "Currency": "CHF"},
-    {"Symbol": 'IBNL25', "FullName": "AEX25_CFD", "Exchange": "SMART", "Currency": "EUR"},
-    {"Symbol": 'IBEU50', "FullName": "Euronext50_CFD", "Exchange": "SMART", "Currency": "EUR"},
-    {"Symbol": 'IBAU200', "FullName": "ASX200_CFD", "Exchange": "SMART", "Currency": "AUD"},
-    {"Symbol": 'IBHK50', "FullName": "HangSeng50_CFD", "Exchange": "SMART", "Currency": "HKD"},
-    {"Symbol": 'IBJP225', "FullName": "Nikkei225_CFD", "Exchange": "SMART", "Currency": "JPY"},
-]
-
-indices_list: List[Dict] = [
-    # {"Symbol": 'STI', "FullName": "StraitsTimesIndex_Ind", "Exchange": "SGX", "Currency": "SGD"},  # no market permission
-    {"Symbol": 'SPX', "FullName": "S&P500_Ind", "Exchange": "CBOE", "Currency": "USD"},
-    {"Symbol": 'INDU', "FullName": "DowJonesIndustrialAverage_Ind", "Exchange": "CME", "Currency": "USD"},
-    # {"Symbol": 'NDX', "FullName": "Nasdaq100_Ind", "Exchange": "NASDAQ", "Currency": "USD"},
-    # {"Symbol": 'NK', "FullName": "Nikkei225_Ind", "Exchange": "CME", "Currency": "USD"},  # don't like mismatched currency
-]
-
-futures_list: List[Dict] = [
-    # US futures exchanges
-    {"Symbol": 'HG', "FullName": "Copper_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'ZO', "FullName": "Oat_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZF', "FullName": "5_year_treasury_note_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZN', "FullName": "10_year_treasury_note_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZB', "FullName": "30_year_treasury_bond_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'YM', "FullName": "Dow_Jones_Industrial_Average_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'EMD', "FullName": "S&P_MidCap_400_Mini_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'ES', "FullName": "S&P_500_Mini_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'NQ', "FullName": "Nasdaq_100_mini_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'NKD', "FullName": "Nikkei225_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'PL', "FullName": "Platinum_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'BZ', "FullName": "Brent_Crude_Oil_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'CL', "FullName": "Light_sweet_crude_oil_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'GC', "FullName": "Gold_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'ZT', "FullName": "2_year_treasury_note_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZQ', "FullName": "30_day_fed_funds_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    # {"Symbol": 'SI', "FullName": "Silver_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'ZC', "FullName": "Corn_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZW', "FullName": "Wheat_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZS', "FullName": "Soybean_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZM', "FullName": "Soybean_meal_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZL', "FullName": "Soybean_oil_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'ZR', "FullName": "Rough_rice_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'NG', "FullName": "Natural_gas_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'AC', "FullName": "Ethanol_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    {"Symbol": 'BRR', "FullName": "Bitcoin_FUT", "Exchange": "CMECRYPTO", "Currency": "USD"},
-    {"Symbol": 'AUD', "FullName": "AUDUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'JPY', "FullName": "JPYUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'EUR', "FullName": "EURUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'GBP', "FullName": "GBPUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'CAD', "FullName": "CADUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'NZD', "FullName": "NZDUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'MXP', "FullName": "MXPUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'RUR', "FullName": "RURUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'BRE', "FullName": "BREUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'ZAR', "FullName": "ZARUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'SEK', "FullName": "SEKUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'NOK', "FullName": "NOKUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'NZD', "FullName": "NZDUSD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'SIR', "FullName": "Indian_rupee_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'CHF', "FullName": "CHF_USD_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXB', "FullName": "Materials_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXE', "FullName": "Energy_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXI', "FullName": "Industrial_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXM', "FullName": "Financial_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXR', "FullName": "Consumer_Staples_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXT', "FullName": "Technology_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXU', "FullName": "Utilities_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    # {"Symbol": 'IXV', "FullName": "HealthCare_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXY', "FullName": "Consumer_Discretionary_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'IXRE', "FullName": "Real_Estate_Select_Sector_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'GF', "FullName": "Feeder_Cattle_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    {"Symbol": 'HE', "FullName": "Lean_Hogs_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    # Futures symbols below sometimes do not contain downloadable data. But usually can download over weekend
-    {"Symbol": 'HO', "FullName": "Heating_Oil_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'RB', "FullName": "Gasoline_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    # {"Symbol": 'HRC', "FullName": "Coil_Steel_Hot_Rolled_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    {"Symbol": 'PA', "FullName": "Palladium_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    # {"Symbol": 'TT', "FullName": "Cotton_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    # {"Symbol": 'SMC', "FullName": "S&P_600_SmallCap_FUT", "Exchange": "GLOBEX", "Currency": "USD"},
-    # {"Symbol": 'UX', "FullName": "Uranium_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    # {"Symbol": 'TIO', "FullName": "Iron_ore_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-
-    # Futures Symbols below are small and illiquid
-    # {"Symbol": 'QI', "FullName": "Silver_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-    # {"Symbol": 'YC', "FullName": "Corn_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    # {"Symbol": 'YK', "FullName": "Soybeans_FUT", "Exchange": "ECBOT", "Currency": "USD"},
-    # {"Symbol": 'QG', "FullName": "Natural_Gas_FUT", "Exchange": "NYMEX", "Currency": "USD"},
-
-    # SGX exchange futures
-    # {"Symbol": 'IU', "FullName": "USDINR_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'KU', "FullName": "KRWUSD_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'M1CNX', "FullName": "ChinaMSCI_TotalReturnFUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'MXID', "FullName": "IndonesiaMSCI_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'NIFTY', "FullName": "CNX_Nifty_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'SSG', "FullName": "Singapore_MSCI_FUT", "Exchange": "SGX", "Currency": "SGD"},
-    # {"Symbol": 'STW', "FullName": "Taiwan_MSCI_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'XINA50', "FullName": "XinhuaA50_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'UC', "FullName": "USDCNH_FUT", "Exchange": "SGX", "Currency": "CNH"},
-    # {"Symbol": 'US', "FullName": "USDSGD_FUT", "Exchange": "SGX", "Currency": "SGD"},
-    # {"Symbol": 'MXTH', "FullName": "ThailandMSCI_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'MXMY', "FullName": "MalaysiaMSCI_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'CY', "FullName": "CNYUSD_FUT", "Exchange": "SGX", "Currency": "USD"},
-    # {"Symbol": 'M3CNX', "FullName": "ChinaMSCI_FUT", "Exchange": "SGX", "Currency": "USD"},
-
-    # Eurex exchange futures
-    # {"Symbol": 'DAX', "FullName": "DAX30_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESTX50', "FullName": "EuroStoxx50_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESA', "FullName": "EuroStoxxAutoAndParts_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESE', "FullName": "EuroStoxxOilAndGas_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESI', "FullName": "EuroStoxxInsurance_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESM', "FullName": "EuroStoxxMedia_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESU', "FullName": "EuroStoxxUtilities_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'SX3P', "FullName": "Stoxx600FoodAndBeverage_FUT", "Exchange": "DTB", "Currency": "EUR"},
-    # {"Symbol": 'ESF', "FullName": "EuroStoxxFinancialServices_FUT", "Exchange": "DTB", "Currency": "EUR"},  #  low signal occurrence. chart full of gaps
-
-    # HKFE exchange futures
-    # {"Symbol": 'MHI', "FullName": "HangSengInd_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-    # {"Symbol": 'HHI.HK', "FullName": "HSCEI_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-    # {"Symbol": 'VHSI', "FullName": "HangSengVolatilityInd_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-    # {"Symbol": 'HB3', "FullName": "Hibor3mth_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-    # {"Symbol": 'IBOV', "FullName": "BovespaInd_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-    # {"Symbol": 'INDEXCF', "FullName": "MicexInd_FUT", "Exchange": "HKFE", "Currency": "HKD"},
-
-    # not downloaded because of inconvenient currency
-    # {"Symbol": 'NIY', "FullName": "Nikkei225_FUT", "Exchange": "GLOBEX", "Currency": "JPY"},
-]
+# load universe file, e.g. universe.toml, of contracts to download.
+# return download list of each contract type in universe_contract_types, with entries as returned by
+# get_universe_entry(). Entries are validated at startup and duplicates of a contract, i.e. with the same
+# contract type, Symbol, Exchange and Currency, are dropped, so that each contract is requested once per run
+def load_universe(filepath: str) -> Dict[str, List[Dict]]:
+    try:
+        import tomllib  # Python 3.11+
+    except ImportError:
+        import tomli as tomllib
+
+    with open(filepath, "rb") as f:
+        config = tomllib.load(f)
+    unknown_contract_types = sorted(set(config) - set(universe_contract_types))
+    if unknown_contract_types:
+        raise ValueError(filepath + ": unknown contract types " + ", ".join(unknown_contract_types))
+
+    universe: Dict[str, List[Dict]] = {}
+    for contract_type in universe_contract_types:
+        universe[contract_type] = []
+        keys = set()
+        for entry in config.get(contract_type, []):
+            if not isinstance(entry, (str, dict)):
+                raise ValueError(filepath + " " + contract_type + ": entry " + repr(entry)
+                                 + " must be a table or a forex pair")
+            entry = get_universe_entry(entry, contract_type=contract_type)
+            validate_universe_entry(entry, contract_type=contract_type, filepath=filepath)
+            key = ContractCache.get_key(symbol_dict=entry, contract_type=contract_type)
+            if key in keys:
+                logger.warning("Duplicate contract " + key + " in " + filepath + ". Downloaded once")
+                continue
+            keys.add(key)
+            universe[contract_type].append(entry)
+    logger.info("Loaded " + ", ".join(str(len(universe[contract_type])) + " " + contract_type
+                                     for contract_type in universe_contract_types) + " contracts from " + filepath)
+    return universe
 
 
 def main() -> None:
@@ -477,12 +2865,33 @@ def main() -> None:
     ib_paper_trading_api_port_number = 7498  # paper trading account
     # ib_api_port_number = ib_paper_trading_api_port_number
     ib_api_port_number = ib_live_trading_api_port_number
-    if ib_api_port_number == ib_live_trading_api_port_number:
-        ib.connect('127.0.0.1', ib_api_port_number, clientId=1, readonly=True)
+    # more than 1 to spread requests over several client ids connected to the same TWS/Gateway
+    number_of_connections = 1
+    if number_of_connections > 1:
+        connect_ib_pool(host='127.0.0.1', port=ib_api_port_number, number_of_connections=number_of_connections,
+                        readonly=ib_api_port_number != ib_paper_trading_api_port_number)
+    elif ib_api_port_number == ib_live_trading_api_port_number:
+        connect_ib('127.0.0.1', ib_api_port_number, client_id=1, readonly=True)
     elif ib_api_port_number == ib_paper_trading_api_port_number:
-        ib.connect('127.0.0.1', ib_api_port_number, clientId=1, readonly=False)
+        connect_ib('127.0.0.1', ib_api_port_number, client_id=1, readonly=False)
     else:
-        ib.connect('127.0.0.1', ib_api_port_number, clientId=1, readonly=True)
+        connect_ib('127.0.0.1', ib_api_port_number, client_id=1, readonly=True)
+
+    # historical chunks with a fixed endDateTime are served from this cache after the first download
+    configure_bar_cache(folderpath="./data/cache/")
+    # symbols are resolved to conId and trading hours once a day instead of on every request
+    configure_contract_cache(filepath="./data/cache/contracts.json")
+    # contracts that keep returning no bars are downloaded after all others
+    configure_empty_result_history(filepath="./data/cache/empty_results.json")
+    # transform and write downloaded bars in worker processes, one per core
+    configure_post_processing()
+    # drop bad bars, request gaps again and write a quality report of every csv file
+    configure_quality_gate(folderpath="./data/quality/")
+    # per-request latency, bars, bytes and retries as JSON lines, summarised at the end of the run
+    configure_run_metrics(filepath="./data/metrics/" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".jsonl")
+
+    # contracts to download, see universe.toml
+    universe = load_universe(filepath="./universe.toml")
 
     # Uncomment to download recent intraday data
     data_folderpath = "./data/recent/"
@@ -493,27 +2902,48 @@ def main() -> None:
     # days_to_download = 30
     # days_to_download = 70
     days_to_download = 5
-
-    download_recent_intraday_data(folderpath=data_folderpath, number_of_days=days_to_download,
-                                  download_list=cfd_list, contract_type="cfd")
-    download_recent_intraday_data(folderpath=data_folderpath, number_of_days=days_to_download,
-                                  download_list=forex_symbol_list, contract_type="forex")
-    download_recent_intraday_data(folderpath=data_folderpath, number_of_days=days_to_download,
-                                  download_list=futures_list, contract_type="cont_futures")
-
-    # download_recent_intraday_data(folderpath=data_folderpath, number_of_days=days_to_download,
-    #                               download_list=indices_list, contract_type="index")
+    # "append" to only download bars since the last bar of existing csv files in data_folderpath
+    update_mode = "overwrite"
+    # add "parquet" or "arrow" to also write columnar files partitioned by symbol and year
+    output_formats = ("csv",)
+    # e.g. ("4 hours", "1 day") to also write coarser bars derived from the hourly bars, with update_mode "overwrite"
+    resample_bar_sizes = ()
+
+    # True to keep running instead of downloading once: markets with an open session are refreshed over the
+    # same connection after every bar close, and the status is served on http://127.0.0.1:8765/
+    daemon_mode = False
+
+    # cfd, forex and futures from one queue, highest priority in universe.toml first. Add "index" to also
+    # download indices
+    if daemon_mode:
+        run_daemon(folderpath=data_folderpath, universe=universe, number_of_days=days_to_download,
+                   host='127.0.0.1', port=ib_api_port_number, client_id=1,
+                   readonly=ib_api_port_number != ib_paper_trading_api_port_number,
+                   contract_types=("cfd", "forex", "cont_futures"), output_formats=output_formats)
+    else:
+        download_recent_universe_data(folderpath=data_folderpath, number_of_days=days_to_download, universe=universe,
+                                      contract_types=("cfd", "forex", "cont_futures"),
+                                      update_mode=update_mode, output_formats=output_formats,
+                                      resample_bar_sizes=resample_bar_sizes)
 
     # Uncomment to download historical intraday data. Go back to multi-year data
+    # an interrupted download resumes from its manifest when run again
     # data_folderpath = "./data/historical/"
     # download_historical_intraday_data(contract_type="forex", folderpath=historical_data_folderpath,
-    #                                   download_list=forex_symbol_list)
+    #                                   download_list=universe["forex"],
+    #                                   manifest_filepath=historical_data_folderpath + "forex_backfill.sqlite")
     # download_historical_intraday_data(contract_type="cfd", folderpath=historical_data_folderpath,
-    #                                   download_list=cfd_list)
+    #                                   download_list=universe["cfd"],
+    #                                   manifest_filepath=historical_data_folderpath + "cfd_backfill.sqlite")
     # download_historical_intraday_data(contract_type="index", folderpath=historical_data_folderpath,
-    #                                   download_list=indices_list)
+    #                                   download_list=universe["index"],
+    #                                   manifest_filepath=historical_data_folderpath + "index_backfill.sqlite")
     # download_historical_intraday_data(contract_type="cont_futures", folderpath=historical_data_folderpath,
-    #                                   download_list=futures_list)
+    #                                   download_list=universe["cont_futures"],
+    #                                   manifest_filepath=historical_data_folderpath + "cont_futures_backfill.sqlite")
+
+    shutdown_post_processing()
+    run_metrics.log_summary()
     return None
 
 